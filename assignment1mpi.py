@@ -3,44 +3,342 @@
 # -----------------------------------------------------------------------------
 
 import sys
+import os
+import struct
+import hashlib
+import pickle
+import mmap
+import argparse
+import contextlib
+import cProfile
+import pstats
 import ijson, json
+from json.decoder import scanstring
 import re
-import math
-import itertools
 import io
-from collections import defaultdict, OrderedDict
-from mpi4py import MPI
+import functools
+import array
+import heapq
+import operator
+import time
+import threading
+import platform
+import tracemalloc
+import multiprocessing
+import multiprocessing.connection
+from collections import defaultdict
+
+# mpi4py is only needed by the MPI engine, which initialises MPI itself so
+# that the other engines can fork worker processes safely.
+try:
+    import mpi4py
+    mpi4py.rc.initialize = False
+    mpi4py.rc.finalize = True
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+# resource is only available on Unix, where peak memory can be reported.
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # -----------------------------------------------------------------------------
 
 PARTITION = '\n#-------------------------------------------------------------\n'
 
-# Setting up MPI parameters.
-comm = MPI.COMM_WORLD
-size = comm.Get_size()
-rank = comm.Get_rank()
-read = MPI.MODE_RDONLY
+# Number of bytes read at a time when looking for the end of a row.
+PROBE_SIZE = 4096
 
-# int dicts to count hashtags and languages used.
-hashtag_dict = defaultdict(int)
-lang_dict = defaultdict(int)
+# Adaptive chunks hold at least this many of the longest rows seen, and
+# shrink back once their parse throughput drops by more than this ratio.
+ROWS_PER_CHUNK = 4
+THROUGHPUT_DROP = 0.9
 
-if rank == 0:
-    # Language code json, compiled according to the lang's section from
-    # https://developer.twitter.com/en/docs/tweets/rules-and-filtering/overview/premium-operators
-    
-    # Load a json file containing language codes, if available in the same
-    # directory. Skip otherwise.
-    try:
-        with open('languageCodes.json') as lang_code_json:
-            LANG_CODES = json.loads(lang_code_json.read())
-        print('Language code json loaded successfully. Continue...\n')
+# Byte values used when framing rows.
+HEADER_START = b'{"total_rows"'
+WHITESPACE = b' \t\r\n'
+COMMA = ord(',')
+OPENING_BRACE = ord('{')
 
-    except:
-        print('Language code json undetected. Continue...\n')
+# Used to locate fields in a row without decoding it: a json string literal,
+# the bytes other than quotes and brackets, and the opening brackets.
+JSON_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+NOT_STRUCTURAL = bytes(set(range(256)) - set(b'"{}[]'))
+OPENING_BRACKETS = b'{['
+
+# Sidecar index of the rows of a file: a header holding a magic string, the
+# size and modification time in ns of the file and the number of rows,
+# followed by the offset of every row. The dump's opening and closing lines
+# are not rows.
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'ROWIDX02'
+INDEX_HEADER = struct.Struct('<8sQQQ')
+ROW_OFFSET = struct.Struct('<Q')
+
+# Cache of the counts of chunks, keyed by a hash of the chunk's content.
+# The version is hashed along, to be bumped whenever the counting changes.
+CACHE_VERSION = b'counts-2'
+CACHE_KEY_SIZE = 16
+CACHE_SUFFIX = '.counts'
+
+# State of the incremental mode, saved next to the input file. The processed
+# part of the file is hashed block by block to detect that it was rewritten.
+STATE_SUFFIX = '.state'
+STATE_BLOCK = 16 * 2 ** 20
+STATE_HASH_SIZE = 16
+
+# Tag of the messages sent when merging counts along a tree, and of those
+# sent by the collective operations of the local engines.
+MERGE_TAG = 1
+COLLECTIVE_TAG = -1
+
+# Stages of a worker timed with --timing, in the order they are reported.
+# Hashtag extraction is part of parsing.
+STAGES = ['open', 'index', 'partition', 'read', 'framing', 'parse',
+          'hashtags', 'cache', 'barrier', 'merge', 'scoreboard']
+
+# Profiles written by --profile, one per worker and one merged, and number
+# of functions listed in the merged summary.
+PROFILE_NAME = 'profile.{0}.pstats'
+PROFILE_TOP = 25
+
+# Files whose allocations are left out of the allocation sites reported.
+TRACEMALLOC_IGNORED = [tracemalloc.__file__, '<frozen importlib._bootstrap>',
+                       '<frozen importlib._bootstrap_external>', '<unknown>']
+
+# Hashtags made of ASCII word characters, followed by the non-ASCII word
+# character (str) or bytes (UTF-8) that would make them non-ASCII, if any.
+HASHTAG = re.compile(r'#([0-9A-Za-z_]+)(\w?)')
+HASHTAG_BYTES = re.compile(rb'#([0-9A-Za-z_]+)([\x80-\xff]*)')
+
+# Lowercase hashtags of the words met so far, cleared when it gets too large.
+HASHTAG_CACHE = {}
+HASHTAG_CACHE_SIZE = 1 << 20
+
+# -----------------------------------------------------------------------------
+
+class Span:
+    ''' 
+    Context manager adding the time spent in it to a worker's list of spans,
+    as a (stage, start, end) triple in seconds of `wtime`.
+    '''
+    __slots__ = ('spans', 'stage', 'start')
+
+    def __init__(self, spans, stage):
+        self.spans = spans
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = wtime()
+
+    def __exit__(self, *exc_info):
+        self.spans.append((self.stage, self.start, wtime()))
+
+# Context manager used in place of a `Span` when timing is disabled.
+NO_SPAN = contextlib.nullcontext()
+
+class LocalComm:
+    ''' 
+    Communicator between worker processes of a single machine, used by the
+    processes and serial engines in place of `MPI.COMM_WORLD`. It mirrors the
+    methods of mpi4py's communicators used by this script, on top of one
+    queue per worker.
+    '''
+
+    def __init__(self, rank, inboxes, barrier, counter):
+        self.rank = rank
+        self.inboxes = inboxes
+        self.barrier = barrier
+        self.counter = counter
+
+        # Messages received while waiting for another one.
+        self.pending = []
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return len(self.inboxes)
+
+    def Barrier(self):
+        self.barrier.wait()
+
+    def send(self, obj, dest, tag = 0):
+        self.inboxes[dest].put((self.rank, tag, obj))
+
+    def recv(self, source, tag = 0):
+        while True:
+            for position, (message_source, message_tag, obj) in \
+                    enumerate(self.pending):
+                if message_source == source and message_tag == tag:
+                    del self.pending[position]
+                    return obj
+            self.pending.append(self.inboxes[self.rank].get())
+
+    def bcast(self, obj, root = 0):
+        if self.rank != root:
+            return self.recv(root, COLLECTIVE_TAG)
+        for dest in range(self.Get_size()):
+            if dest != root:
+                self.send(obj, dest, COLLECTIVE_TAG)
+        return obj
+
+    def gather(self, obj, root = 0):
+        if self.rank != root:
+            self.send(obj, root, COLLECTIVE_TAG)
+            return None
+        return [obj if source == root else self.recv(source, COLLECTIVE_TAG)
+                for source in range(self.Get_size())]
+
+    def allreduce(self, obj):
+        all_objs = self.gather(obj)
+        return self.bcast(sum(all_objs) if self.rank == 0 else None)
+
+    def exscan(self, obj):
+        all_objs = self.bcast(self.gather(obj))
+        return sum(all_objs[:self.rank]) if self.rank else None
+
+class LocalFile:
+    ''' 
+    File opened by every worker of a `LocalComm`, mirroring the methods of
+    `MPI.File` used by this script. Reads and writes at different offsets
+    are independent, so the collective ones are the same as the others.
+    '''
+
+    def __init__(self, file_name, mode = 'r'):
+        if mode == 'r':
+            self.file = open(file_name, 'rb', buffering = 0)
+        else:
+            self.file = open(os.open(file_name, os.O_RDWR | os.O_CREAT,
+                                     0o666), 'r+b', buffering = 0)
+
+        # Reads may run in the background, so the file position is shared
+        # by a lock where reads at an offset are not available.
+        self.lock = threading.Lock()
+
+    def Get_size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def Set_size(self, file_size):
+        self.file.truncate(file_size)
+
+    def Read_at(self, offset, buffer):
+        if not hasattr(os, 'preadv'):
+            with self.lock:
+                self.file.seek(offset)
+                self.file.readinto(buffer)
+            return
+
+        buffer = memoryview(buffer)
+        while buffer:
+            count = os.preadv(self.file.fileno(), [buffer], offset)
+            if count == 0:
+                return
+            buffer = buffer[count:]
+            offset += count
+
+    def Iread_at(self, offset, buffer):
+        return LocalRequest(self.Read_at, offset, buffer)
+
+    def Write_at(self, offset, data):
+        data = memoryview(data)
+        self.file.seek(offset)
+        while data:
+            data = data[self.file.write(data):]
+
+    Read_at_all = Read_at
+    Iread_at_all = Iread_at
+    Write_at_all = Write_at
+
+    def Close(self):
+        self.file.close()
+
+class LocalRequest:
+    ''' 
+    Read of a `LocalFile` run in a thread of its own, mirroring the method of
+    `MPI.Request` used by this script.
+    '''
+
+    def __init__(self, read_at, offset, buffer):
+        self.error = None
+        self.thread = threading.Thread(target = self.run,
+                                       args = (read_at, offset, buffer))
+        self.thread.start()
+
+    def run(self, read_at, offset, buffer):
+        try:
+            read_at(offset, buffer)
+        except Exception as error:
+            self.error = error
+
+    def Wait(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+class LocalCounter:
+    ''' 
+    Counter shared by the workers of a `LocalComm`, used in place of the MPI
+    window made by `create_counter`.
+    '''
+
+    def __init__(self):
+        self.value = multiprocessing.Value('q', 0)
+
+    def fetch_and_increment(self):
+        with self.value.get_lock():
+            value = self.value.value
+            self.value.value += 1
+        return value
+
+    def Free(self):
         pass
 
-    print('Number of workers: ' + str(size) +'.')
+def local_comms(size):
+    ''' 
+    This function return the `LocalComm` of each of `size` workers, which
+    must then be run in processes of their own, or in this one if `size`
+    is 1.
+    '''
+    inboxes = [multiprocessing.Queue() for _ in range(size)]
+    barrier = multiprocessing.Barrier(size)
+    counter = LocalCounter()
+
+    return [LocalComm(rank, inboxes, barrier, counter)
+            for rank in range(size)]
+
+def open_file(comm, file_name, mode = 'r'):
+    ''' 
+    This function opens a file for every worker of `comm`, for reading, or
+    for writing if `mode` is 'w', and return it. MPI files are opened for
+    MPI communicators, and `LocalFile` ones for `LocalComm` ones.
+    '''
+    if isinstance(comm, LocalComm):
+        return LocalFile(file_name, mode)
+    if mode == 'r':
+        return MPI.File.Open(comm, file_name, MPI.MODE_RDONLY)
+    return MPI.File.Open(comm, file_name, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+
+def stage(spans, name):
+    ''' 
+    This function return a context manager timing the stage `name` into the
+    list `spans`, or doing nothing if `spans` is `None`, i.e. if timing is
+    disabled.
+    '''
+    if spans is None:
+        return NO_SPAN
+    return Span(spans, name)
+
+def wtime():
+    ''' 
+    This function return the elapsed wall clock time in seconds, as given by
+    MPI when it is in use.
+    '''
+    if MPI is not None and MPI.Is_initialized():
+        return MPI.Wtime()
+    return time.perf_counter()
 
 # -----------------------------------------------------------------------------
 
@@ -58,6 +356,873 @@ def hashtags_from_text(tweet_text):
     # Return unique hashtags found.
     return set(hashtags)
 
+def hashtags_from_texts(texts):
+    ''' 
+    This function takes a list of tweets' texts, each given either as a str
+    or as UTF-8 bytes, and return their hashtag(s) as a list of sets, one per
+    text, the same as calling `hashtags_from_text` on each text.
+    '''
+    lowercase = HASHTAG_CACHE
+    if len(lowercase) > HASHTAG_CACHE_SIZE:
+        lowercase.clear()
+
+    all_hashtags = []
+    for text in texts:
+        hashtags = set()
+
+        # Hashtags are made of ASCII word characters only. Those followed by
+        # a non-ASCII word character are not ASCII as a whole, so ignore them.
+        if isinstance(text, str):
+            for word, non_ascii in HASHTAG.findall(text):
+                if non_ascii:
+                    continue
+                hashtag = lowercase.get(word)
+                if hashtag is None:
+                    hashtag = lowercase[word] = '#' + word.lower()
+                hashtags.add(hashtag)
+
+        else:
+            for word, non_ascii in HASHTAG_BYTES.findall(text):
+                if non_ascii and non_ascii.decode('utf-8', 'ignore')[:1] \
+                                          .isalnum():
+                    continue
+                hashtag = lowercase.get(word)
+                if hashtag is None:
+                    hashtag = lowercase[word] = '#' + word.decode('ascii') \
+                                                          .lower()
+                hashtags.add(hashtag)
+
+        all_hashtags.append(hashtags)
+
+    return all_hashtags
+
+def row_boundary(read_file, offset, file_size, probe_size = PROBE_SIZE):
+    ''' 
+    This function takes an opened MPI file, a byte offset and the file's size
+    and return the offset at which the first row starting at or after `offset`
+    begins, i.e. right after the first new line character found from
+    `offset - 1` onwards. Returns the file size if no such row exists.
+    The file is read `probe_size` bytes at a time.
+    '''
+
+    # The start and the end of the file are always row boundaries.
+    if offset <= 0:
+        return 0
+    if offset >= file_size:
+        return file_size
+
+    # Probe a few KB at a time until a new line character is found, so rows
+    # of any length are handled.
+    probe = bytearray(probe_size)
+    position = offset - 1
+    while position < file_size:
+        read_file.Read_at(position, probe)
+        probe_end = min(probe_size, file_size - position)
+        newline = probe.find(b'\n', 0, probe_end)
+        if newline != -1:
+            return position + newline + 1
+        position += probe_end
+
+    return file_size
+
+def row_ranges(read_file, file_size, start, end, parts):
+    ''' 
+    This function splits the byte range [`start`, `end`) of an opened MPI file
+    into `parts` consecutive [start, end) ranges of whole rows and return them
+    as a list. `start` and `end` must be row boundaries themselves.
+    Some ranges may be empty if a single row spans several split points.
+    '''
+    boundaries = [start]
+    for part in range(1, parts):
+        split_point = start + (end - start) * part // parts
+        boundaries.append(min(max(row_boundary(read_file, split_point,
+                                               file_size), start), end))
+    boundaries.append(end)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def block_ranges(read_file, file_size, start, end, block_size):
+    ''' 
+    This function splits the byte range [`start`, `end`) of an opened MPI
+    file, whose ends must be row boundaries, at the first row boundary after
+    each multiple of `block_size` bytes from the start of the file, and
+    return the non-empty [start, end) ranges of whole rows as a list. Unlike
+    those of `row_ranges`, the cuts do not depend on the size of the file
+    or on the number of workers.
+    '''
+    boundaries = [start]
+    for offset in range(start - start % block_size + block_size, end,
+                        block_size):
+        boundary = row_boundary(read_file, offset, file_size)
+        if boundaries[-1] < boundary < end:
+            boundaries.append(boundary)
+    boundaries.append(end)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+class ChunkSizer:
+    ''' 
+    Size of the next chunk of a worker: the largest that fits in its memory
+    budget along with the parser's copies, never less than a few of the
+    longest rows seen so far, and grown while the parse throughput holds and
+    shrunk once it drops.
+    '''
+
+    def __init__(self, memory, buffers, size):
+
+        # Each byte of a chunk is held by one of the buffers, and copied at
+        # most once more by the parser.
+        self.limit = max(memory // (buffers + 1), PROBE_SIZE)
+        self.size = max(min(size, self.limit), PROBE_SIZE)
+        self.largest = 0
+        self.longest_row = 0
+        self.throughput = None
+        self.factor = 2
+
+    def probe_size(self):
+        ''' 
+        This function return the number of bytes to read at a time when
+        looking for the end of a row, enough for the longest row seen.
+        '''
+        return max(PROBE_SIZE, self.longest_row + 1)
+
+    def record(self, length, seconds, longest_row):
+        ''' 
+        This function takes the length of the chunk just parsed, the time
+        taken and its longest row, and sizes the next chunk accordingly.
+        '''
+        self.largest = max(self.largest, length)
+        self.longest_row = max(self.longest_row, longest_row)
+
+        # Keep growing, or shrinking, the chunks while the throughput holds,
+        # and turn back once it drops.
+        if seconds > 0:
+            throughput = length / seconds
+            if self.throughput is not None and \
+               throughput < self.throughput * THROUGHPUT_DROP:
+                self.factor = 1 / self.factor
+            self.throughput = throughput
+
+        self.size = int(min(max(self.size * self.factor,
+                                self.longest_row * ROWS_PER_CHUNK,
+                                PROBE_SIZE), self.limit))
+
+def sized_ranges(read_file, file_size, start, end, sizer):
+    ''' 
+    This function splits the byte range [`start`, `end`) of an opened MPI file
+    into consecutive [start, end) ranges of whole rows and yields them one at
+    a time, each of about the size given by the `ChunkSizer` at the time.
+    `start` and `end` must be row boundaries themselves.
+    '''
+    while start < end:
+        chunk_end = min(max(row_boundary(read_file, start + sizer.size,
+                                         file_size, sizer.probe_size()),
+                            start), end)
+        yield start, chunk_end
+        start = chunk_end
+
+def longest_row(chunk_data, start, end):
+    ''' 
+    This function return the length of the longest row of the buffer
+    holding one row per line in [`start`, `end`).
+    '''
+    longest = 0
+    line_start = start
+    while line_start < end:
+        line_end = chunk_data.find(b'\n', line_start, end)
+        if line_end == -1:
+            line_end = end
+        longest = max(longest, line_end - line_start)
+        line_start = line_end + 1
+
+    return longest
+
+def line_starts(chunk_data, length, offset, starts):
+    ''' 
+    This function takes a buffer holding `length` bytes of whole rows read
+    from `offset` in the file and appends the file offset of every row
+    start in the buffer to the array `starts`. Only lines holding a tweet
+    count as rows, not the dump's opening and closing lines.
+    '''
+    position = 0
+    while position < length:
+        if chunk_data[position] == OPENING_BRACE and \
+           not chunk_data.startswith(HEADER_START, position):
+            starts.append(offset + position)
+        newline = chunk_data.find(b'\n', position, length)
+        if newline == -1:
+            return
+        position = newline + 1
+
+def build_index(comm, read_file, file_size, file_stat, index_name,
+                chunk_num):
+    ''' 
+    This function makes every rank of `comm` find the start of the rows in
+    its share of the opened MPI file and writes them all to `index_name` as
+    a little-endian uint64 array, after a header holding the file's size and
+    modification time, as given by `file_stat`, and the number of rows.
+    It must be called by all ranks and return the number of rows.
+    '''
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # Each rank scans an equal share of the file, chunk by chunk.
+    worker_start = row_boundary(read_file, file_size * rank // size,
+                                file_size)
+    worker_end = row_boundary(read_file, file_size * (rank + 1) // size,
+                              file_size)
+    chunk_ranges = row_ranges(read_file, file_size, worker_start, worker_end,
+                              chunk_num)
+    chunk_buffer = bytearray(max([chunk_end - chunk_start
+                                  for chunk_start, chunk_end in chunk_ranges]))
+    chunk_view = memoryview(chunk_buffer)
+
+    starts = array.array('Q')
+    for chunk_start, chunk_end in chunk_ranges:
+        read_file.Read_at_all(chunk_start,
+                              chunk_view[:chunk_end - chunk_start])
+        line_starts(chunk_buffer, chunk_end - chunk_start, chunk_start,
+                    starts)
+    if sys.byteorder == 'big':
+        starts.byteswap()
+
+    # Rows found by lower ranks come first.
+    row_count = comm.allreduce(len(starts))
+    first_row = comm.exscan(len(starts)) or 0
+
+    # Write a temporary file first so that an interrupted build never
+    # leaves an index that looks valid.
+    index_file = open_file(comm, index_name + '.tmp', 'w')
+    index_file.Set_size(INDEX_HEADER.size + ROW_OFFSET.size * row_count)
+    if rank == 0:
+        index_file.Write_at(0, INDEX_HEADER.pack(
+            INDEX_MAGIC, file_stat.st_size, file_stat.st_mtime_ns, row_count))
+    index_file.Write_at_all(INDEX_HEADER.size + ROW_OFFSET.size * first_row,
+                            memoryview(starts).cast('B'))
+    index_file.Close()
+
+    # Closing a `LocalFile` does not wait for the other workers, so no one
+    # may still be writing the temporary file when it is renamed.
+    comm.Barrier()
+    if rank == 0:
+        os.replace(index_name + '.tmp', index_name)
+    comm.Barrier()
+
+    return row_count
+
+def read_index_header(index_name):
+    ''' 
+    This function return the size and modification time of the indexed file
+    and the number of rows stored in the header of an index, or `None` if
+    the index is missing or invalid.
+    '''
+    try:
+        with open(index_name, 'rb') as index_file:
+            header = index_file.read(INDEX_HEADER.size)
+    except OSError:
+        return None
+
+    if len(header) < INDEX_HEADER.size:
+        return None
+    magic, file_size, mtime_ns, row_count = INDEX_HEADER.unpack(header)
+    if magic != INDEX_MAGIC:
+        return None
+
+    return file_size, mtime_ns, row_count
+
+def index_is_fresh(index_name, file_stat):
+    ''' 
+    This function checks that an index was built from a file of the size and
+    modification time given by `file_stat`, and that it holds the offsets
+    of all of its rows, i.e. that it was not cut short.
+    '''
+    header = read_index_header(index_name)
+    return header is not None and \
+           header[:2] == (file_stat.st_size, file_stat.st_mtime_ns) and \
+           os.path.getsize(index_name) == INDEX_HEADER.size + \
+                                          ROW_OFFSET.size * header[2]
+
+def indexed_ranges(index_name, first_row, last_row, parts):
+    ''' 
+    This function splits rows [`first_row`, `last_row`) of an indexed file
+    into `parts` consecutive [start, end) byte ranges holding the same
+    number of rows, give or take one, and return them as a list.
+    Only the offsets needed are read from the index.
+    '''
+    file_size, _, row_count = read_index_header(index_name)
+
+    boundaries = []
+    with open(index_name, 'rb') as index_file:
+        for part in range(parts + 1):
+            row = first_row + (last_row - first_row) * part // parts
+            if row >= row_count:
+                boundaries.append(file_size)
+                continue
+            index_file.seek(INDEX_HEADER.size + ROW_OFFSET.size * row)
+            boundaries.append(ROW_OFFSET.unpack(
+                index_file.read(ROW_OFFSET.size))[0])
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def cache_key(rows, parser):
+    ''' 
+    This function return the key under which the counts of some rows, given
+    as a bytes-like object, are cached: a hash of the rows' content and of
+    the name of the parser counting them, as parsers drop malformed rows
+    differently.
+    '''
+    digest = hashlib.blake2b(CACHE_VERSION, digest_size = CACHE_KEY_SIZE)
+    digest.update(parser.encode())
+    digest.update(b'\0')
+    digest.update(rows)
+
+    return digest.hexdigest()
+
+def load_cached_counts(cache_dir, key):
+    ''' 
+    This function return the hashtag and language counts cached under `key`
+    in `cache_dir`, along with the numbers of rows parsed and dropped, and
+    marks them as recently used. Returns `None` if there are none.
+    '''
+    cache_name = os.path.join(cache_dir, key + CACHE_SUFFIX)
+    try:
+        with open(cache_name, 'rb') as cache_file:
+            counts = pickle.load(cache_file)
+        os.utime(cache_name)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+    return counts
+
+def store_cached_counts(cache_dir, key, counts):
+    ''' 
+    This function caches the hashtag and language counts of some rows, and
+    the numbers of rows parsed and dropped, under `key` in `cache_dir`. The
+    counts are written to a temporary file first, so that other workers
+    never load them half written.
+    '''
+    cache_name = os.path.join(cache_dir, key + CACHE_SUFFIX)
+    temp_name = '{0}.{1}.tmp'.format(cache_name, os.getpid())
+    with open(temp_name, 'wb') as cache_file:
+        pickle.dump(counts, cache_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_name, cache_name)
+
+def evict_cache(cache_dir, max_bytes):
+    ''' 
+    This function removes the least recently used counts from `cache_dir`
+    until it holds no more than `max_bytes`.
+    '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(CACHE_SUFFIX):
+            entry_stat = entry.stat()
+            entries.append((entry_stat.st_mtime, entry_stat.st_size,
+                            entry.path))
+
+    cache_bytes = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, entry_path in sorted(entries):
+        if cache_bytes <= max_bytes:
+            return
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+        cache_bytes -= entry_size
+
+def last_row_end(file_name, file_size):
+    ''' 
+    This function return the offset right after the last new line character
+    of a file, i.e. the end of its last complete row, or 0 if there is none.
+    A row still being appended to the file is thus left out.
+    '''
+    with open(file_name, 'rb') as input_file:
+        position = file_size
+        while position > 0:
+            block_start = max(position - PROBE_SIZE, 0)
+            input_file.seek(block_start)
+            newline = input_file.read(position - block_start).rfind(b'\n')
+            if newline != -1:
+                return block_start + newline + 1
+            position = block_start
+
+    return 0
+
+def block_hashes(comm, file_name, offset, first_block = 0):
+    ''' 
+    This function makes every rank of `comm` hash its share of the
+    `STATE_BLOCK` sized blocks of the first `offset` bytes of a file, from
+    block `first_block` on, and return the hashes of all of them in order at
+    rank 0, `None` elsewhere. It must be called by all ranks.
+    '''
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    block_count = -(-offset // STATE_BLOCK)
+
+    # Blocks are dealt out to the ranks in turn.
+    hashes = []
+    with open(file_name, 'rb') as input_file:
+        for block in range(first_block + rank, block_count, size):
+            input_file.seek(block * STATE_BLOCK)
+            data = input_file.read(min(STATE_BLOCK,
+                                       offset - block * STATE_BLOCK))
+            hashes.append(hashlib.blake2b(
+                data, digest_size = STATE_HASH_SIZE).digest())
+
+    all_hashes = comm.gather(hashes, root = 0)
+    if rank != 0:
+        return None
+
+    return [all_hashes[block % size][block // size]
+            for block in range(block_count - first_block)]
+
+def load_state(comm, state_name, file_name, file_size):
+    ''' 
+    This function return the offset up to which the file was processed by
+    the last incremental run, the hashtag and language counts found so far
+    and the hashes of the blocks processed, or `None` if there is no state
+    or the file was truncated or any of its processed bytes rewritten since.
+    It must be called by all ranks, which check the blocks together, and
+    the state is only returned at rank 0.
+    '''
+    state = None
+    if comm.Get_rank() == 0:
+        try:
+            with open(state_name, 'rb') as state_file:
+                state = pickle.load(state_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            state = None
+
+        # States saved before the blocks were hashed are not trusted.
+        if state is not None and ('hashes' not in state or
+                                  state['offset'] > file_size):
+            state = None
+
+    offset = comm.bcast(None if state is None else state['offset'],
+                        root = 0)
+    if offset is None:
+        return None
+
+    hashes = block_hashes(comm, file_name, offset)
+    if comm.Get_rank() != 0 or hashes != state['hashes']:
+        return None
+
+    return state['offset'], state['counts'], state['hashes']
+
+def save_state(state_name, offset, counts, hashes):
+    ''' 
+    This function saves the offset up to which the file was processed, the
+    hashtag and language counts found so far and the hashes of the blocks
+    processed, for the next incremental run to carry on from there.
+    '''
+    state = {'offset': offset, 'counts': counts, 'hashes': hashes}
+    with open(state_name + '.tmp', 'wb') as state_file:
+        pickle.dump(state, state_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(state_name + '.tmp', state_name)
+
+def advise(mapping, advice, start, end):
+    ''' 
+    This function gives the kernel a hint, such as `mmap.MADV_WILLNEED`,
+    about how the byte range [`start`, `end`) of a memory mapped file will be
+    used. It does nothing where `madvise` is not available (Python < 3.8).
+    '''
+    if not hasattr(mapping, 'madvise') or end <= start:
+        return
+
+    # The range must start on a page boundary.
+    page_start = start - start % mmap.PAGESIZE
+    mapping.madvise(advice, page_start, end - page_start)
+
+def mapped_chunks(mapping, chunk_ranges):
+    ''' 
+    This function yields a (data, start, end) triple for each [start, end)
+    range of `chunk_ranges`, where data is the memory mapped file itself, so
+    rows are parsed out of it with no copy. Pages of each chunk are asked
+    for before it is processed and dropped from memory afterwards.
+    '''
+    for chunk_start, chunk_end in chunk_ranges:
+        advise(mapping, getattr(mmap, 'MADV_WILLNEED', None), chunk_start,
+               chunk_end)
+        yield mapping, chunk_start, chunk_end
+
+        # The pages are still in the page cache if needed again.
+        advise(mapping, getattr(mmap, 'MADV_DONTNEED', None), chunk_start,
+               chunk_end)
+
+def create_counter(comm):
+    ''' 
+    This function creates a counter starting at 0 in an MPI window held by
+    rank 0, which every rank of `comm` can then atomically fetch and
+    increment. It must be called by all ranks and return the window.
+    '''
+
+    # Workers of a single machine share a counter made with their `comm`.
+    if isinstance(comm, LocalComm):
+        comm.Barrier()
+        return comm.counter
+
+    counter_size = MPI.INT64_T.Get_size()
+    if comm.Get_rank() == 0:
+        counter = MPI.Win.Allocate(counter_size, counter_size, comm = comm)
+
+        # Memory allocated for a window is not initialised.
+        counter.Lock(0)
+        counter.Put([array.array('q', [0]), MPI.INT64_T], 0)
+        counter.Unlock(0)
+    else:
+        counter = MPI.Win.Allocate(0, counter_size, comm = comm)
+
+    # No rank may use the counter before it is initialised.
+    comm.Barrier()
+    return counter
+
+def fetch_and_increment(counter):
+    ''' 
+    This function atomically increments the counter created by
+    `create_counter` and return its value before the increment.
+    '''
+    if isinstance(counter, LocalCounter):
+        return counter.fetch_and_increment()
+
+    increment = array.array('q', [1])
+    value = array.array('q', [0])
+
+    counter.Lock(0)
+    counter.Fetch_and_op([increment, MPI.INT64_T], [value, MPI.INT64_T], 0)
+    counter.Unlock(0)
+
+    return value[0]
+
+def claimed_indexes(counter, chunk_total, stats):
+    ''' 
+    This function yields the index of the next chunk claimed from the shared
+    `counter`, until every one of the `chunk_total` chunks has been claimed
+    by one of the workers. Time spent waiting for the counter is added to
+    `stats['idle']`.
+    '''
+    while True:
+        wait_start = wtime()
+        chunk_index = fetch_and_increment(counter)
+        stats['idle'] += wtime() - wait_start
+
+        if chunk_index >= chunk_total:
+            return
+
+        yield chunk_index
+
+def claimed_ranges(read_file, file_size, start, end, chunk_total, counter,
+                   stats):
+    ''' 
+    This function splits the byte range [`start`, `end`) of the file, whose
+    ends must be row boundaries, in `chunk_total` chunks of whole rows and
+    yields the [start, end) range of the next chunk claimed from the shared
+    `counter`, until every chunk has been claimed by one of the workers.
+    Time spent waiting for the counter is added to `stats['idle']`.
+    '''
+    for chunk_index in claimed_indexes(counter, chunk_total, stats):
+        yield (row_boundary(read_file,
+                            start + (end - start) * chunk_index // chunk_total,
+                            file_size),
+               row_boundary(read_file,
+                            start + (end - start) * (chunk_index + 1)
+                            // chunk_total, file_size))
+
+def read_chunks(read_file, chunk_ranges, buffer_size, collective, prefetch,
+                stats, spans = None):
+    ''' 
+    This function reads each [start, end) range of `chunk_ranges` from an
+    opened file, collectively or not, and yields a (buffer, 0, length)
+    triple with the chunk at the front of the buffer. Buffers of
+    `buffer_size` bytes are reused and grown when needed, so a chunk must be
+    processed before the next one is asked for. With `prefetch`, the next
+    chunk is read in the background into a second buffer while the current
+    one is processed. Time spent waiting for reads is added to
+    `stats['io wait']`, and timed as 'read' spans if `spans` is given.
+    '''
+    buffers = [bytearray(buffer_size) for _ in range(1 + bool(prefetch))]
+    if collective:
+        read_at, iread_at = read_file.Read_at_all, read_file.Iread_at_all
+    else:
+        read_at, iread_at = read_file.Read_at, read_file.Iread_at
+
+    def chunk_view(which, length):
+        if length > len(buffers[which]):
+            buffers[which] = bytearray(length)
+        return memoryview(buffers[which])[:length]
+
+    def wait(read, *read_args):
+        wait_start = wtime()
+        read(*read_args)
+        wait_end = wtime()
+        stats['io wait'] += wait_end - wait_start
+        if spans is not None:
+            spans.append(('read', wait_start, wait_end))
+
+    if not prefetch:
+        for chunk_start, chunk_end in chunk_ranges:
+            with chunk_view(0, chunk_end - chunk_start) as view:
+                wait(read_at, chunk_start, view)
+            yield buffers[0], 0, chunk_end - chunk_start
+        return
+
+    # Reading chunk i + 1 into one buffer is started before chunk i, read
+    # into the other one, is handed out.
+    pending = None
+    which = 0
+    for chunk_start, chunk_end in chunk_ranges:
+        request = iread_at(chunk_start,
+                           chunk_view(which, chunk_end - chunk_start))
+        if pending is not None:
+            wait(pending[0].Wait)
+            yield buffers[pending[1]], 0, pending[2]
+        pending = (request, which, chunk_end - chunk_start)
+        which = 1 - which
+
+    if pending is not None:
+        wait(pending[0].Wait)
+        yield buffers[pending[1]], 0, pending[2]
+
+def row_span(chunk_data, start, end):
+    ''' 
+    This function takes a buffer, or a memory mapped file, holding whole rows
+    cut from the CouchDB dump in [`start`, `end`) and return the narrower
+    (start, end) pair covering the rows only. The dump's opening and closing
+    lines, trailing white spaces and the comma after the last row are left
+    out. Nothing is copied or decoded.
+    '''
+
+    # The opening line of the dump holds the row count and opens `rows`.
+    if chunk_data[start:min(start + len(HEADER_START), end)] == HEADER_START:
+        start = chunk_data.find(b'\n', start, end) + 1 or end
+
+    # The closing line of the dump closes `rows` and the whole document.
+    while end > start and chunk_data[end - 1] in WHITESPACE:
+        end -= 1
+    last_line = max(chunk_data.rfind(b'\n', start, end) + 1, start)
+    if chunk_data[last_line:end].strip() == b']}':
+        end = last_line
+        while end > start and chunk_data[end - 1] in WHITESPACE:
+            end -= 1
+
+    # Every row but the very last one of the dump ends with a comma.
+    if end > start and chunk_data[end - 1] == COMMA:
+        end -= 1
+
+    return start, end
+
+def frame_rows(chunk_view, start, end):
+    ''' 
+    This function takes a memoryview of whole rows and the span returned by
+    `row_span` and return the rows wrapped as a standalone `{"rows":[...]}`
+    json document, as bytes.
+    '''
+    return b''.join((b'{"rows":[', chunk_view[start:end], b']}'))
+
+def find_member(row, start, key):
+    ''' 
+    This function takes a json row as bytes, the offset `start` right after
+    the opening brace of one of its objects, or right after one of the
+    object's values, and a key token such as `b'"text":'`. It return the
+    offset of the value of that key if it is a direct member of the object,
+    without decoding anything. Returns -1 if there is no such member.
+    '''
+    position = start
+    while True:
+        candidate = row.find(key, position)
+        if candidate == -1:
+            return -1
+
+        # Keep only the brackets outside of strings between the start and the
+        # candidate. Strings without escapes are paired up by splitting on
+        # quotes, which is much cheaper than a regex.
+        segment = row[start:candidate]
+        if b'\\' in segment:
+            segment = JSON_STRING.sub(b'', segment)
+            segment = segment.translate(None, NOT_STRUCTURAL)
+            outside_string = b'"' not in segment
+        else:
+            parts = segment.translate(None, NOT_STRUCTURAL).split(b'"')
+            outside_string = len(parts) % 2 == 1
+            segment = b''.join(parts[::2])
+
+        # The candidate is a member if every bracket opened before it is
+        # closed, and the object itself is never closed.
+        if outside_string:
+            depth = 0
+            for bracket in segment:
+                if bracket in OPENING_BRACKETS:
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth < 0:
+                        return -1
+            if depth == 0:
+                return candidate + len(key)
+
+        # The candidate is nested deeper or is part of a string, try the next.
+        position = candidate + 1
+
+def extract_fields(row):
+    ''' 
+    This function takes a row of the CouchDB dump as bytes and return its
+    `doc.text` and `doc.metadata.iso_language_code` as a tuple, decoding only
+    these two values. The text is left as UTF-8 bytes when it has no escape
+    sequence to decode, and is empty when it cannot hold any hashtag.
+    Returns `None` if the values cannot be located unambiguously, in which
+    case the row should be decoded in full.
+    '''
+    if not row.startswith(b'{'):
+        return None
+
+    # The tweet itself.
+    doc = find_member(row, 1, b'"doc":{')
+    if doc == -1:
+        return None
+
+    # Its text.
+    text = find_member(row, doc, b'"text":')
+    if text == -1:
+        return None
+    text = JSON_STRING.match(row, text)
+    if text is None:
+        return None
+
+    # Its metadata, usually found after the text.
+    metadata = find_member(row, text.end(), b'"metadata":{')
+    if metadata == -1:
+        metadata = find_member(row, doc, b'"metadata":{')
+        if metadata == -1:
+            return None
+
+    # Its language.
+    lang_code = find_member(row, metadata, b'"iso_language_code":')
+    if lang_code == -1:
+        return None
+    lang_code = JSON_STRING.match(row, lang_code)
+    if lang_code is None:
+        return None
+
+    # The text only needs decoding when it has escape sequences, one of which
+    # could be a '#'. Values that do not decode, e.g. with an invalid escape
+    # or invalid UTF-8, are left to the full parse to reject.
+    text = text.group()
+    try:
+        if b'\\' in text:
+            text = scanstring(text.decode('utf-8'), 1)[0]
+        elif b'#' in text:
+            text = text[1:-1]
+        else:
+            text = b''
+        lang_code = scanstring(lang_code.group().decode('utf-8'), 1)[0]
+    except ValueError:
+        return None
+
+    return text, lang_code
+
+def count_rows(chunk_data, start, end, hashtag_dict, lang_dict,
+               targeted = True, spans = None):
+    ''' 
+    This function takes a buffer holding one row of the CouchDB dump per line
+    in [`start`, `end`), as returned by `row_span`, and decodes the rows one by
+    one to count their hashtags and languages in the given dictionaries.
+    Only the two fields needed are decoded unless `targeted` is `False` or a
+    row is ambiguous, in which case the whole row is decoded.
+    A malformed row is skipped on its own without affecting the others.
+    Hashtag extraction is timed into `spans` if given. Returns the number of
+    rows parsed and of malformed rows dropped.
+    '''
+    chunk_view = memoryview(chunk_data)
+
+    # Texts of the chunk's tweets that may have hashtags.
+    texts = []
+    rows = dropped = 0
+
+    line_start = start
+    while line_start < end:
+        line_end = chunk_data.find(b'\n', line_start, end)
+        if line_end == -1:
+            line_end = end
+
+        # Every row but the very last one of the dump ends with a comma.
+        row = bytes(chunk_view[line_start:line_end]).rstrip().rstrip(b',')
+        line_start = line_end + 1
+        if not row:
+            continue
+        rows += 1
+
+        # Decode the fields needed only...
+        fields = extract_fields(row) if targeted else None
+        if fields is not None:
+            text, lang_code = fields
+
+        # ... or the whole row.
+        else:
+            try:
+                doc = json.loads(row)['doc']
+                text = doc.get('text')
+                lang_code = (doc.get('metadata') or {}) \
+                            .get('iso_language_code')
+            except (ValueError, KeyError, TypeError, AttributeError):
+                dropped += 1
+                continue
+
+            if not isinstance(text, str) or '#' not in text:
+                text = None
+
+        # Hashtags are extracted for the whole chunk at once.
+        if text:
+            texts.append(text)
+
+        # Increment language's count.
+        if lang_code is not None:
+            lang_dict[lang_code] += 1
+
+    # Increment extracted hashtags'.
+    with stage(spans, 'hashtags'):
+        for hashtags in hashtags_from_texts(texts):
+            for hashtag in hashtags:
+                hashtag_dict[hashtag] += 1
+
+    return rows - dropped, dropped
+
+def count_rows_ijson(chunk_data, start, end, hashtag_dict, lang_dict):
+    ''' 
+    This function does the same as `count_rows`, but wraps the rows into a
+    single json document and streams it through ijson's event parser.
+    The rest of the rows are skipped, and counted as dropped, once a
+    malformed row is met.
+    '''
+    document = frame_rows(memoryview(chunk_data), start, end)
+    lines = document.count(b'\n') + 1 if end > start else 0
+    rows = 0
+
+    # Parse json data straight from bytes, leaving UTF-8 decoding of the
+    # strings to ijson.
+    parser = ijson.parse(io.BytesIO(document))
+    try:
+        for prefix, event, value in parser:
+
+            # Extract hashtags from tweet's text.
+            if prefix == 'rows.item.doc.text':
+                hashtags = hashtags_from_text(value)
+                            
+                # Increment extracted hashtags'.
+                for hashtag in hashtags:
+                    hashtag_dict[hashtag] += 1
+                        
+            # Increment language's count.
+            elif prefix == 'rows.item.doc.metadata.iso_language_code':
+                lang_dict[value] += 1
+
+            # Count the rows parsed to the end.
+            elif prefix == 'rows.item' and event == 'end_map':
+                rows += 1
+    
+    # Skip the rest of a chunk holding malformed data.
+    except:
+        pass
+
+    return rows, lines - rows
+
 def combine_dict(dict_list, dict_type):
     ''' 
     This function takes a list of dictionaries and a defaultdict type
@@ -70,6 +1235,137 @@ def combine_dict(dict_list, dict_type):
 
     return combined_dict
 
+def merge_dicts(target, source):
+    ''' 
+    This function adds the counts of one int defaultdict to another, in
+    place, and return the result. New keys are appended in the order they
+    appear in `source`, so merging workers in rank order keeps ties in the
+    same order as `combine_dict`.
+    '''
+    for key, value in source.items():
+        target[key] += value
+
+    return target
+
+def merge_counts(counts, other_counts):
+    ''' 
+    This function takes two tuples of dictionaries, such as the hashtag and
+    language counts of two workers, and return them merged pairwise.
+    '''
+    return tuple(merge_dicts(target, source)
+                 for target, source in zip(counts, other_counts))
+
+def tree_reduce(comm, counts, merge):
+    ''' 
+    This function merges `counts` from every rank of `comm` pairwise along a
+    binomial tree, so that the merge takes log2(size) rounds and is spread
+    across ranks instead of being done serially at rank 0.
+    `merge` takes two counts and return them merged.
+    Returns the merged counts at rank 0, `None` elsewhere.
+    '''
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # At each round, ranks with the next bit set hand their counts over to
+    # the rank with that bit cleared and leave the tree.
+    step = 1
+    while step < size:
+        if rank & step:
+            comm.send(counts, dest = rank - step, tag = MERGE_TAG)
+            return None
+        if rank + step < size:
+            counts = merge(counts, comm.recv(source = rank + step,
+                                             tag = MERGE_TAG))
+        step *= 2
+
+    return counts
+
+def top_counts(comm, local_dict, n):
+    ''' 
+    This function finds the keys ranked `n`th or better, ties included, in
+    the sum of the int dictionaries held by every rank of `comm`, without
+    sending whole dictionaries, following the three-phase uniform threshold
+    (TPUT) algorithm:
+    1. Ranks send their local top `n`, whose partial sums give a lower bound
+       `tau1` for the `n`th total. No key totalling `tau1` or more can count
+       less than `tau1 / size` on every rank.
+    2. Ranks send their keys counting at least `tau1 / size`. The partial
+       sums give a higher lower bound `tau2` and an upper bound for each key,
+       ruling out keys whose upper bound is below `tau2`.
+    3. Ranks send their exact counts for the remaining candidates.
+    Returns at rank 0 a dict of the exact totals of the candidates, which
+    `scoreboard` ranks the same as the sum of all dictionaries, with ties
+    in the same order. Returns `None` elsewhere.
+    '''
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # Phase 1: local top `n`.
+    local_top = dict(heapq.nlargest(n, local_dict.items(),
+                                    key = operator.itemgetter(1)))
+    all_reports = comm.gather(local_top, root = 0)
+
+    threshold = None
+    if rank == 0:
+        partial_sums = combine_dict(all_reports, int)
+        tau1 = nth_largest(partial_sums.values(), n)
+        threshold = tau1 / size
+    threshold = comm.bcast(threshold, root = 0)
+
+    # Phase 2: keys counting at least the threshold and not sent yet.
+    above_threshold = {key: value for key, value in local_dict.items()
+                       if value >= threshold and key not in local_top}
+    all_above = comm.gather(above_threshold, root = 0)
+
+    candidates = None
+    if rank == 0:
+        for report, above in zip(all_reports, all_above):
+            report.update(above)
+        partial_sums = combine_dict(all_reports, int)
+        tau2 = nth_largest(partial_sums.values(), n)
+
+        # A rank that did not report a key counts it below the threshold.
+        reporters = combine_dict([dict.fromkeys(report, 1)
+                                  for report in all_reports], int)
+        candidates = [key for key, value in partial_sums.items()
+                      if value + (size - reporters[key]) * threshold >= tau2]
+    candidates = comm.bcast(candidates, root = 0)
+
+    # Phase 3: exact counts of the candidates, along with where they are in
+    # the local dictionary so that ties keep their order.
+    candidate_set = set(candidates)
+    exact_counts = [(position, key, local_dict[key])
+                    for position, key in enumerate(local_dict)
+                    if key in candidate_set]
+    all_exact_counts = comm.gather(exact_counts, root = 0)
+
+    if rank != 0:
+        return None
+
+    # Insert keys in the order `combine_dict` would have met them.
+    totals = defaultdict(int)
+    for exact_counts in all_exact_counts:
+        for position, key, value in exact_counts:
+            totals[key] += value
+    first_seen = {}
+    for worker, exact_counts in enumerate(all_exact_counts):
+        for position, key, value in exact_counts:
+            first_seen.setdefault(key, (worker, position))
+
+    return defaultdict(int, [(key, totals[key]) for key
+                             in sorted(totals, key = first_seen.get)])
+
+def nth_largest(values, n):
+    ''' 
+    This function return the `n`th largest of `values`, or 0 if there are
+    fewer than `n` values.
+    '''
+    largest = heapq.nlargest(n, values)
+    if len(largest) < n:
+        return 0
+
+    return largest[-1]
+
 def scoreboard(input_dict, n, title, reverse_flag, lang_code_dict = None):
     ''' 
     This function takes a dictionary and return the top `n` keys 
@@ -83,22 +1379,31 @@ def scoreboard(input_dict, n, title, reverse_flag, lang_code_dict = None):
 
     print(PARTITION)
 
-    # Sort the dictionary.
-    sorted_dict = sorted(input_dict.items(), key = lambda x: x[1], 
-                        reverse = reverse_flag)
-    sorted_dict = OrderedDict(sorted_dict)
+    # Find the value of the `n`th entry with a heap, then keep the entries
+    # at least as good as it, ties at the `n`th place included.
+    if reverse_flag:
+        top_values = heapq.nlargest(n, input_dict.values())
+        top_items = [item for item in input_dict.items()
+                     if top_values and item[1] >= top_values[-1]]
+    else:
+        top_values = heapq.nsmallest(n, input_dict.values())
+        top_items = [item for item in input_dict.items()
+                     if top_values and item[1] <= top_values[-1]]
+
+    # Sort the entries kept. Sorting is stable, so tied keys keep their order.
+    top_items.sort(key = operator.itemgetter(1), reverse = reverse_flag)
 
     # Current rank to be printed.
     current_rank = 1
 
     # Rank and value of the previous key, used to handle ties.
     # Their initial values are that of the first key.
-    prev_val = list(sorted_dict.items())[0][1]
+    prev_val = top_items[0][1] if top_items else None
     prev_rank = 1
 
     # Print the scoreboard entry by entry.
     print(title +'\n')
-    for key, value in sorted_dict.items():
+    for key, value in top_items:
 
         # No more last place ties, return.
         if current_rank > n and value != prev_val:
@@ -149,144 +1454,938 @@ def scoreboard(input_dict, n, title, reverse_flag, lang_code_dict = None):
         prev_val = value
         current_rank += 1
 
+def print_workload(all_stats):
+    ''' 
+    This function takes the list of stats dictionaries gathered from every
+    worker and prints how many chunks each of them processed and how long
+    it was busy and idle, and how much of the busy time went on waiting for
+    reads.
+    '''
+
+    print(PARTITION)
+    print('Workload per worker.\n')
+    print('{0:>6} {1:>8} {2:>10} {3:>10} {4:>12}'.format(
+          'Worker', 'Chunks', 'Busy (s)', 'Idle (s)', 'I/O wait (s)'))
+    for worker, stats in enumerate(all_stats):
+        print('{0:>6} {1:>8} {2:>10.3f} {3:>10.3f} {4:>12.3f}'.format(
+              worker, int(stats['chunks']), stats['busy'], stats['idle'],
+              stats['io wait']))
+
+def print_balance(all_stats):
+    ''' 
+    This function takes the list of stats dictionaries gathered from every
+    worker and prints the bytes, rows parsed and dropped, hashtags found,
+    distinct hashtags and time spent computing and waiting of each worker,
+    followed by the imbalance of each of them: the maximum over the mean.
+    '''
+    columns = [[stats['bytes'] / 2 ** 20 for stats in all_stats],
+               [stats['rows'] for stats in all_stats],
+               [stats['dropped rows'] for stats in all_stats],
+               [stats['hashtags'] for stats in all_stats],
+               [stats['distinct hashtags'] for stats in all_stats],
+               [stats['busy'] - stats['io wait'] for stats in all_stats],
+               [stats['idle'] + stats['io wait'] for stats in all_stats]]
+    row_format = '{0:>9} {1:>8.1f} {2:>9.0f} {3:>8.0f} {4:>9.0f} {5:>9.0f} ' \
+                 '{6:>11.3f} {7:>9.3f}'
+
+    print(PARTITION)
+    print('Balance between workers.\n')
+    print('{0:>9} {1:>8} {2:>9} {3:>8} {4:>9} {5:>9} {6:>11} {7:>9}'.format(
+          'Worker', 'MB', 'Rows', 'Dropped', 'Hashtags', 'Distinct',
+          'Compute (s)', 'Wait (s)'))
+    for worker in range(len(all_stats)):
+        print(row_format.format(worker,
+                                *[column[worker] for column in columns]))
+
+    # A perfectly balanced column has an imbalance of 1.
+    imbalances = []
+    for column in columns:
+        mean = sum(column) / len(column)
+        imbalances.append(max(column) / mean if mean else 1.0)
+    print(('{0:>9} {1:>8.2f} {2:>9.2f} {3:>8.2f} {4:>9.2f} {5:>9.2f} '
+           '{6:>11.2f} {7:>9.2f}').format('Max/mean', *imbalances))
+
+def stage_totals(spans):
+    ''' 
+    This function return the total time in seconds and the number of spans
+    of each stage found in a list of spans, as a dict of [time, count].
+    '''
+    totals = {}
+    for name, start, end in spans:
+        total = totals.setdefault(name, [0.0, 0])
+        total[0] += end - start
+        total[1] += 1
+
+    return totals
+
+def print_timing(all_spans, json_name = None):
+    ''' 
+    This function takes the list of spans of every worker and prints the
+    minimum, maximum and mean time each stage took across workers, and the
+    number of spans, e.g. of reads. The table is also saved to `json_name`
+    as json if given.
+    '''
+    all_totals = [stage_totals(spans) for spans in all_spans]
+    names = [name for name in STAGES
+             if any(name in totals for totals in all_totals)]
+    names += sorted(set(name for totals in all_totals for name in totals)
+                    - set(names))
+
+    print(PARTITION)
+    print('Time per stage across {0} workers.\n'.format(len(all_spans)))
+    print('{0:>12} {1:>8} {2:>10} {3:>10} {4:>10}'.format(
+          'Stage', 'Spans', 'Min (s)', 'Max (s)', 'Mean (s)'))
+
+    table = {}
+    for name in names:
+        times = [totals.get(name, (0.0, 0))[0] for totals in all_totals]
+        spans = sum(totals.get(name, (0.0, 0))[1] for totals in all_totals)
+        table[name] = {'spans': spans, 'min': min(times), 'max': max(times),
+                       'mean': sum(times) / len(times), 'workers': times}
+        print('{0:>12} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f}'.format(
+              name, spans, table[name]['min'], table[name]['max'],
+              table[name]['mean']))
+
+    if json_name:
+        with open(json_name, 'w') as json_file:
+            json.dump({'workers': len(all_spans), 'stages': table}, json_file,
+                      indent = 2)
+
+def print_profile(profile_names, merged_name):
+    ''' 
+    This function merges the profiles of every worker, saves them to
+    `merged_name` and prints the functions that took the most time in
+    total across workers.
+    '''
+    merged_stats = pstats.Stats(*profile_names)
+    merged_stats.dump_stats(merged_name)
+
+    print(PARTITION)
+    print('Hottest functions across {0} workers, merged into {1}.\n'.format(
+          len(profile_names), merged_name))
+    merged_stats.strip_dirs().sort_stats('tottime').print_stats(PROFILE_TOP)
+
+def write_trace(trace_name, all_spans):
+    ''' 
+    This function takes the start time and the list of spans of every worker
+    and writes them to `trace_name` in the Trace Event Format, with one
+    track per worker, to be opened in chrome://tracing or Perfetto.
+    '''
+    events = []
+    for worker, (start, spans) in enumerate(all_spans):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': worker,
+                       'args': {'name': 'Worker {0}'.format(worker)}})
+        events.append({'name': 'process_sort_index', 'ph': 'M',
+                       'pid': worker, 'args': {'sort_index': worker}})
+
+        # Times are in microseconds since the worker started.
+        for name, span_start, span_end in spans:
+            events.append({'name': name, 'cat': 'stage', 'ph': 'X',
+                           'pid': worker, 'tid': 0,
+                           'ts': (span_start - start) * 1e6,
+                           'dur': (span_end - span_start) * 1e6})
+
+    with open(trace_name, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                  trace_file)
+
+def peak_rss():
+    ''' 
+    This function return the peak resident set size of this process in
+    bytes, or `None` where it cannot be measured.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def node_memory():
+    ''' 
+    This function return the physical memory of this node in bytes, or
+    `None` where it cannot be measured.
+    '''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def table_size(table):
+    ''' 
+    This function takes a dictionary of counts and return an estimate of
+    the memory it holds in bytes: the dictionary itself, its keys and its
+    values.
+    '''
+    return sys.getsizeof(table) + sum(sys.getsizeof(key) +
+                                      sys.getsizeof(value)
+                                      for key, value in table.items())
+
+def allocation_sites(snapshot, n):
+    ''' 
+    This function takes a tracemalloc snapshot and return the `n` lines
+    holding the most memory in it, as a list of (site, size, count) tuples
+    which can be sent to another worker.
+    '''
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, name)
+                                       for name in TRACEMALLOC_IGNORED])
+    sites = []
+    for statistic in snapshot.statistics('lineno')[:n]:
+        frame = statistic.traceback[0]
+        sites.append(('{0}:{1}'.format(os.path.basename(frame.filename),
+                                       frame.lineno),
+                      statistic.size, statistic.count))
+
+    return sites
+
+def print_memory(all_memory, merged_size, n):
+    ''' 
+    This function takes the memory use gathered from every worker and the
+    size of the tables merged at the master, and prints the peak resident
+    memory and count tables of each worker, the `n` allocation sites
+    holding the most memory across workers if they were traced, and how
+    many workers fit in the memory of each node.
+    '''
+    megabyte = 2 ** 20
+
+    print(PARTITION)
+    print('Memory per worker, in MB, besides the number of distinct '
+          'hashtags (Keys).\n')
+    print('{0:>6} {1:>12} {2:>9} {3:>10} {4:>9} {5:>9} {6:>8} {7:>8}'.format(
+          'Worker', 'Node', 'Peak RSS', 'Keys', 'Hashtags', 'Languages',
+          'Traced', 'Peak'))
+    for worker, memory in enumerate(all_memory):
+        peak = memory['peak rss']
+        traced = memory['traced']
+        print('{0:>6} {1:>12.12} {2:>9} {3:>10} {4:>9.1f} {5:>9.3f} {6:>8} '
+              '{7:>8}'.format(
+              worker, memory['node'],
+              '-' if peak is None else '{0:.1f}'.format(peak / megabyte),
+              memory['hashtags'], memory['hashtag table'] / megabyte,
+              memory['lang table'] / megabyte,
+              '-' if traced is None else '{0:.1f}'.format(
+                  traced[0] / megabyte),
+              '-' if traced is None else '{0:.1f}'.format(
+                  traced[1] / megabyte)))
+    print('\nMerged tables at the master: {0:.1f} MB.'.format(
+          merged_size / megabyte))
+
+    # Sites are merged by file and line across workers.
+    if all_memory[0]['sites'] is not None:
+        sites = defaultdict(lambda: [0, 0])
+        for memory in all_memory:
+            for site, site_size, count in memory['sites']:
+                sites[site][0] += site_size
+                sites[site][1] += count
+
+        print('\nAllocation sites holding the most memory after counting, '
+              'across workers.\n')
+        print('{0:>40} {1:>10} {2:>10}'.format('Site', 'MB', 'Blocks'))
+        for site, (site_size, count) in heapq.nlargest(
+                n, sites.items(), key = lambda item: item[1][0]):
+            print('{0:>40.40} {1:>10.1f} {2:>10}'.format(
+                  site, site_size / megabyte, count))
+
+    # The master also holds the merged tables, so it is counted apart from
+    # the other workers of its node.
+    nodes = defaultdict(list)
+    for worker, memory in enumerate(all_memory):
+        nodes[memory['node']].append((worker, memory))
+    if any(memory['peak rss'] is None for memory in all_memory):
+        return
+
+    print('\nWorkers per node.\n')
+    for node, workers in nodes.items():
+        peaks = [memory['peak rss'] for _, memory in workers]
+        total = workers[0][1]['node memory']
+        master_peak = sum(memory['peak rss'] for worker, memory in workers
+                          if worker == 0)
+        worker_peak = max([memory['peak rss'] for worker, memory in workers
+                           if worker != 0] or peaks)
+        line = '{0}: {1} worker(s), {2:.1f} MB at peak'.format(
+               node, len(workers), sum(peaks) / megabyte)
+        if total is not None:
+            fits = int((total - master_peak) // worker_peak) + \
+                   (1 if master_peak else 0)
+            line += ', about {0} worker(s) of {1:.1f} MB fit in ' \
+                    '{2:.0f} MB'.format(fits, worker_peak / megabyte,
+                                        total / megabyte)
+        print(line + '.')
+
+def load_lang_codes():
+    ''' 
+    This function loads a json file containing language codes, if available
+    in the same directory, and return it as a dict. Returns `None` otherwise.
+    '''
+
+    # Language code json, compiled according to the lang's section from
+    # https://developer.twitter.com/en/docs/tweets/rules-and-filtering/overview/premium-operators
+    try:
+        with open('languageCodes.json') as lang_code_json:
+            lang_codes = json.loads(lang_code_json.read())
+        print('Language code json loaded successfully. Continue...\n')
+        return lang_codes
+
+    except:
+        print('Language code json undetected. Continue...\n')
+        return None
+
+def parse_arguments():
+    ''' 
+    This function reads the command line arguments and return them.
+    '''
+    parser = argparse.ArgumentParser(
+        description = 'Count hashtags and languages in a Twitter json dump.')
+    parser.add_argument('file_name', nargs = '?',
+                        help = 'json file to be processed.')
+    parser.add_argument('--engine', choices = ['mpi', 'processes', 'serial'],
+                        default = 'mpi' if MPI is not None else 'processes',
+                        help = 'run a worker per rank started by mpirun '
+                               '(default if mpi4py is installed), a worker '
+                               'per process started on this machine, or a '
+                               'single worker in this process.')
+    parser.add_argument('--workers', type = int,
+                        default = os.cpu_count() or 1,
+                        help = 'number of processes started by the '
+                               'processes engine (default: one per core).')
+    parser.add_argument('--parser', choices = ['fields', 'rows', 'ijson'],
+                        default = 'fields',
+                        help = 'decode only the fields needed from each row '
+                               '(default), decode whole rows, or stream '
+                               'whole chunks through ijson.')
+    parser.add_argument('--io', choices = ['collective', 'independent',
+                                           'pread', 'mmap'],
+                        default = 'collective',
+                        help = 'read chunks into a buffer with collective '
+                               'MPI-IO (default), with independent MPI-IO '
+                               'so that workers do not wait for each other '
+                               'at every chunk, or with plain reads at an '
+                               'offset; or memory map the file and parse '
+                               'rows straight out of the mapping, e.g. when '
+                               'running on a single node.')
+    parser.add_argument('--memory', type = int, metavar = 'MB',
+                        help = 'size the chunks of each worker on the fly, '
+                               'as large as fits in MB along with the '
+                               'parser\'s copies and as fast to parse as '
+                               'possible, instead of a fixed number of '
+                               'chunks. Chunks are then read independently.')
+    parser.add_argument('--prefetch', action = 'store_true',
+                        help = 'read the next chunk in the background while '
+                               'the current one is parsed, using two '
+                               'buffers.')
+    parser.add_argument('--schedule', choices = ['static', 'dynamic'],
+                        default = 'static',
+                        help = 'give each worker an equal share of the file '
+                               '(default), or have workers claim chunks on '
+                               'demand until the file is exhausted.')
+    parser.add_argument('--index', action = 'store_true',
+                        help = 'give each worker the same number of rows '
+                               'using a sidecar index of row offsets, which '
+                               'is built first if missing or stale.')
+    parser.add_argument('--build-index', action = 'store_true',
+                        help = 'only build the sidecar index and exit.')
+    parser.add_argument('--cache', metavar = 'DIR',
+                        help = 'cache the counts of each chunk in DIR, keyed '
+                               'by its content, and only count the chunks '
+                               'not cached yet. Chunks are then blocks cut '
+                               'at fixed offsets of the file, which stay '
+                               'the same when rows are appended or the '
+                               'number of workers changes.')
+    parser.add_argument('--cache-block', type = int, default = 16,
+                        metavar = 'MB',
+                        help = 'size of the blocks cached (default: 16).')
+    parser.add_argument('--cache-size', type = int, default = 1024,
+                        metavar = 'MB',
+                        help = 'size above which the least recently used '
+                               'counts are evicted from the cache '
+                               '(default: 1024).')
+    parser.add_argument('--incremental', action = 'store_true',
+                        help = 'only process the rows appended since the '
+                               'last incremental run and add them to the '
+                               'counts saved by it. The whole file is '
+                               'processed if it was truncated or any of its '
+                               'processed bytes rewritten, which is checked '
+                               'by hashing them again, spread over the '
+                               'workers.')
+    parser.add_argument('--merge', choices = ['gather', 'tree', 'topk'],
+                        default = 'gather',
+                        help = 'gather all counts at the master and combine '
+                               'them there (default), merge them pairwise '
+                               'along a binomial tree, or only send the '
+                               'hashtags that may make the top N.')
+    parser.add_argument('--profile', action = 'store_true',
+                        help = 'run every worker under cProfile, write its '
+                               'profile to profile.RANK.pstats and print the '
+                               'hottest functions across workers.')
+    parser.add_argument('--profile-dir', default = '.', metavar = 'DIR',
+                        help = 'directory the profiles are written to '
+                               '(default: the current one).')
+    parser.add_argument('--timing', action = 'store_true',
+                        help = 'time each stage on every worker and print '
+                               'the min, max and mean time across workers.')
+    parser.add_argument('--timing-json', metavar = 'FILE',
+                        help = 'same as --timing, and also save the table to '
+                               'FILE as json.')
+    parser.add_argument('--trace', metavar = 'FILE',
+                        help = 'write the timeline of the stages of every '
+                               'worker to FILE in the Trace Event Format, '
+                               'to be opened in chrome://tracing or '
+                               'Perfetto.')
+    parser.add_argument('--memory-report', action = 'store_true',
+                        help = 'report the peak resident memory and the size '
+                               'of the count tables of every worker, and how '
+                               'many workers fit in the memory of a node.')
+    parser.add_argument('--tracemalloc', type = int, default = 0,
+                        metavar = 'N',
+                        help = 'same as --memory-report, and also trace '
+                               'allocations with tracemalloc and print the N '
+                               'sites holding the most memory after '
+                               'counting. Slows the run down.')
+    parser.add_argument('--counts', metavar = 'FILE',
+                        help = 'also save the counts of every hashtag and '
+                               'language to FILE as json.')
+    args = parser.parse_args()
+
+    if args.engine == 'mpi' and MPI is None:
+        parser.error('mpi4py is not installed, use --engine processes or '
+                     'serial.')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1.')
+    if args.timing_json:
+        args.timing = True
+    if args.tracemalloc < 0:
+        parser.error('--tracemalloc must be at least 0.')
+    if args.tracemalloc:
+        args.memory_report = True
+    if args.profile:
+        os.makedirs(args.profile_dir, exist_ok = True)
+    if args.memory is not None and args.memory < 1:
+        parser.error('--memory must be at least 1.')
+
+    if args.cache_block < 1:
+        parser.error('--cache-block must be at least 1.')
+
+    # Claimed, indexed and cached chunks are split before any of them is
+    # parsed.
+    if args.memory and (args.schedule == 'dynamic' or args.index or
+                        args.cache):
+        parser.error('--memory only applies to the static schedule, '
+                     'without --index or --cache.')
+
+    # Only some of the hashtags reach the master with the top N merge.
+    if (args.incremental or args.counts) and args.merge == 'topk':
+        parser.error('--incremental and --counts need all counts, use '
+                     '--merge gather or tree.')
+
+    return args
+
 # -----------------------------------------------------------------------------
 
-# Take name of the file to be processed from the command line. 
-# Program will exit if input file is not specified.
-if (len(sys.argv) > 1):
-    file_name = sys.argv[1]
-else:
+def run(comm, args):
+    ''' 
+    This function counts the hashtags and languages of the file given in
+    `args` as one of the workers of `comm`, either an MPI communicator or a
+    `LocalComm`, and prints the scoreboards at the master.
+    '''
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # int dicts to count hashtags and languages used.
+    hashtag_dict = defaultdict(int)
+    lang_dict = defaultdict(int)
+
     if rank == 0:
-        sys.exit('No json file specified. Please try again.')
-    sys.exit()
+        LANG_CODES = load_lang_codes()
+        print('Number of workers: ' + str(size) +'.')
 
-# -----------------------------------------------------------------------------
-# Read the file and get its size in byte.
-read_file = MPI.File.Open(comm, file_name, read)
-file_size = MPI.File.Get_size(read_file)
-      
-# Add some extra memory to buffer to avoid breaking the json structure.
-# i.e some data in the end of one chunk and some data at the start of 
-# the next chunk will overlap.
-# Choose 20KB to be on the safe side.
-overlap_size = 20480
-
-# Buffer size for each worker.
-buffer_size = int(math.ceil(file_size/size))
-    
-# Each worker will start reading at their respective offset.
-worker_offset = buffer_size * rank
+    # Program will exit if input file is not specified.
+    if args.file_name is None:
+        if rank == 0:
+            sys.exit('No json file specified. Please try again.')
+        sys.exit()
 
-# Have each worker read one chunk of their assigned part at a time to 
-# prevent integer overflow. Adjust value as needed.
-if size < 2:
-    chunk_num = 128
-else:
-    chunk_num = 32
+    # Spans of time spent in each stage, if they are timed or traced.
+    spans = [] if args.timing or args.trace else None
 
-# Size of each chunk in bytes.
-chunk_size = int(math.ceil(buffer_size/chunk_num))
+    # Engine used to count the rows of each chunk.
+    if args.parser == 'ijson':
+        count_chunk = count_rows_ijson
+    elif args.parser == 'rows':
+        count_chunk = functools.partial(count_rows, targeted = False,
+                                        spans = spans)
+    else:
+        count_chunk = functools.partial(count_rows, spans = spans)
 
-for i in range(chunk_num):
-        
-    chunk_offset = worker_offset + chunk_size * i
+    # Allocations are traced from the start, to find what holds memory.
+    if args.tracemalloc:
+        tracemalloc.start()
 
-    # Read each chunk and overlapping data.
-    chunk_buffer = bytearray(chunk_size + overlap_size)
-    read_file.Read_at_all(chunk_offset, chunk_buffer)
+    # Workers start together when traced, so that their timelines line up
+    # even if their clocks do not.
+    if args.trace:
+        comm.Barrier()
+    run_start = wtime()
 
-    # Overlapping data only.
-    overlap_buffer = bytearray(overlap_size)
-    read_file.Read_at_all(chunk_offset + chunk_size, overlap_buffer)
-    
-    # Convert data in buffers to string.
-    chunk_string = chunk_buffer.decode('utf-8', 'ignore').strip('\x00')
-    overlap_string = overlap_buffer.decode('utf-8', 'ignore').strip('\x00')
+    # -------------------------------------------------------------------------
+    # Read the file and get its size in byte.
+    with stage(spans, 'open'):
+        read_file = open_file(comm, args.file_name)
+        file_size = read_file.Get_size()
 
-    # Free memory.
-    chunk_buffer = overlap_buffer = None
+    # Have each worker read one chunk of their assigned part at a time to 
+    # prevent integer overflow. Adjust value as needed.
+    if size < 2:
+        chunk_num = 128
+    else:
+        chunk_num = 32
 
-    # Find the index position where the overlapped data starts in the whole
-    # data.
-    overlap_index = chunk_string.rfind(overlap_string)
+    # Build the index of row offsets if asked to, or if it is missing or
+    # does not match the file any more.
+    index_name = args.file_name + INDEX_SUFFIX
+    if args.index or args.build_index:
 
-    # Adjusting chunk to process accounting for the overlapped data.
-    # Each chunk  will begin after the first new line character
-    # from the start...
-    chunk_start = chunk_string.index('\n') + 1
+        # Master decides for all workers, as the build is collective.
+        file_stat = index_fresh = None
+        if rank == 0:
+            file_stat = os.stat(args.file_name)
+            index_fresh = index_is_fresh(index_name, file_stat)
+        file_stat, index_fresh = comm.bcast((file_stat, index_fresh),
+                                            root = 0)
 
-    # ... and each chunk except for the last one of the last worker
-    # will stop at the first new line character in the overlap region,
-    # thus we will avoid having to process a tweet broken by splitting data.
-    if rank == size - 1 and i == chunk_num - 1:
-        chunk_string = chunk_string[chunk_start: ]
+        if args.build_index or not index_fresh:
+            with stage(spans, 'index'):
+                row_count = build_index(comm, read_file, file_size,
+                                        file_stat, index_name, chunk_num)
+            if rank == 0:
+                print('Row index built: {0} rows.'.format(row_count))
 
-        # Fix the json chunk if necessary.
-        try:
-            json.load(chunk_string)
-        except:
-            chunk_string = '{"rows":[\n' + chunk_string[:-3] + ']}'
+        if args.build_index:
+            read_file.Close()
+            return
+
+    # Number of chunks processed and time spent busy and idle by the worker.
+    stats = defaultdict(float)
+
+    if args.cache:
+        os.makedirs(args.cache, exist_ok = True)
+
+    # Part of the file to be processed: all of it, or only the complete rows
+    # appended since the last incremental run.
+    start_offset, end_offset = 0, file_size
+    if args.incremental:
+        state_name = args.file_name + STATE_SUFFIX
+        if rank == 0:
+            end_offset = last_row_end(args.file_name, file_size)
+        end_offset = comm.bcast(end_offset, root = 0)
+        state = load_state(comm, state_name, args.file_name, end_offset)
+        if rank == 0:
+            if state is None:
+                print('No state matching the file, processing all of it.')
+            else:
+                start_offset = state[0]
+                print('Processing the {0} bytes appended since the last '
+                      'run.'.format(end_offset - start_offset))
+        start_offset, end_offset = comm.bcast((start_offset, end_offset),
+                                              root = 0)
+
+    partition_start = wtime()
+
+    if args.schedule == 'dynamic':
+
+        # The file is split into chunks of whole rows, which workers claim
+        # one at a time from a shared counter and read independently, so
+        # that faster workers end up processing more chunks.
+        counter = create_counter(comm)
+        if args.cache:
+            blocks = block_ranges(read_file, file_size, start_offset,
+                                  end_offset, args.cache_block * 2 ** 20)
+            chunk_ranges = (blocks[chunk_index] for chunk_index
+                            in claimed_indexes(counter, len(blocks), stats))
+            buffer_size = max([block_end - block_start
+                               for block_start, block_end in blocks]
+                              + [PROBE_SIZE])
+        else:
+            chunk_ranges = claimed_ranges(read_file, file_size,
+                                          start_offset, end_offset,
+                                          chunk_num * size, counter, stats)
+
+            # The buffers start at the expected chunk size and grow if
+            # needed.
+            buffer_size = ((end_offset - start_offset) // (chunk_num * size)
+                           + PROBE_SIZE)
+
+    elif args.cache:
+
+        # Chunks are blocks at fixed offsets of the file, so that they keep
+        # their content, and their cached counts, whatever the number of
+        # workers and whatever is appended to the file. Each worker gets as
+        # many consecutive blocks as the others, give or take one, and empty
+        # chunks make up the difference so that they all read as many chunks
+        # collectively.
+        blocks = block_ranges(read_file, file_size, start_offset, end_offset,
+                              args.cache_block * 2 ** 20)
+        chunk_ranges = blocks[len(blocks) * rank // size:
+                              len(blocks) * (rank + 1) // size]
+        chunk_ranges += [(end_offset, end_offset)] * (
+            max(-(-len(blocks) // size), 1) - len(chunk_ranges))
+
+    elif args.index and not args.incremental:
+
+        # Each worker is assigned the same number of rows, give or take one,
+        # and so is each chunk.
+        row_count = read_index_header(index_name)[2]
+        chunk_ranges = indexed_ranges(index_name, row_count * rank // size,
+                                      row_count * (rank + 1) // size,
+                                      chunk_num)
 
     else:
-        chunk_end = overlap_index + overlap_string.index('\n')
-        chunk_string = chunk_string[chunk_start: chunk_end]
 
-        # Fix the json chunk if necessary.
-        try:
-            json.load(chunk_string)
-        except:
-            chunk_string = '{"rows":[\n' + chunk_string[:-2] + ']}'
+        # Each worker is assigned an equal share of the file, with both ends
+        # moved forward to the start of the next row so that no tweet is
+        # split between workers and every byte is read and parsed exactly
+        # once.
+        worker_start = row_boundary(
+            read_file, start_offset + (end_offset - start_offset) * rank
+            // size, file_size)
+        worker_end = row_boundary(
+            read_file, start_offset + (end_offset - start_offset)
+            * (rank + 1) // size, file_size)
 
-    # Parse json data.
-    parser = ijson.parse(io.StringIO(chunk_string))
-    try:
-        for prefix, event, value in parser:
+        # Chunks are made of whole rows as well, and sized on the fly to fit
+        # the memory budget if there is one.
+        if args.memory:
+            sizer = ChunkSizer(args.memory * 2 ** 20,
+                               1 + (args.prefetch and args.io != 'mmap'),
+                               (worker_end - worker_start) // chunk_num)
+            chunk_ranges = sized_ranges(read_file, file_size, worker_start,
+                                        worker_end, sizer)
+        else:
+            chunk_ranges = row_ranges(read_file, file_size, worker_start,
+                                      worker_end, chunk_num)
 
-            # Extract hashtags from tweet's text.
-            if prefix == 'rows.item.doc.text':
-                hashtags = hashtags_from_text(value)
-                            
-                # Increment extracted hashtags'.
-                for hashtag in hashtags:
-                    hashtag_dict[hashtag] += 1
-                        
-            # Increment language's count.
-            elif prefix == 'rows.item.doc.metadata.iso_language_code':
-                lang_dict[value] += 1
-    
-    # Skip any trailing bytes at the end resulted from the splitting process.
-    except:
-        pass
+    # Buffers large enough for the largest chunk are allocated once and
+    # reused for every chunk of the worker.
+    if args.memory:
+        buffer_size = sizer.size
+    elif args.schedule != 'dynamic':
+        buffer_size = max([chunk_end - chunk_start
+                           for chunk_start, chunk_end in chunk_ranges])
 
-# Close the file after reading.
-read_file.Close()
+    if spans is not None:
+        spans.append(('partition', partition_start, wtime()))
 
-comm.Barrier()
+    if args.io == 'mmap':
 
-# Gather the dictionaries from all worker.
-all_hashtag_dicts = comm.gather(hashtag_dict, root = 0)
-all_lang_dicts = comm.gather(lang_dict, root = 0)
+        # The file is mapped once, and pages of each chunk are dropped from
+        # the worker's memory once counted, so memory use stays flat.
+        if file_size:
+            with open(args.file_name, 'rb') as map_file:
+                mapping = mmap.mmap(map_file.fileno(), 0,
+                                    access = mmap.ACCESS_READ)
+        else:
+            mapping = b''
+        if hasattr(mapping, 'madvise'):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+        chunks = mapped_chunks(mapping, chunk_ranges)
 
-comm.Barrier()
+    # Each chunk is read into the front of a buffer, through a file of the
+    # worker's own for plain reads. Claimed and adaptive chunks differ
+    # between workers, so they can only be read independently.
+    else:
+        if args.io == 'pread':
+            chunk_file = LocalFile(args.file_name)
+        else:
+            chunk_file = read_file
+        chunks = read_chunks(chunk_file, chunk_ranges, buffer_size,
+                             args.io == 'collective'
+                             and args.schedule != 'dynamic'
+                             and not args.memory, args.prefetch, stats,
+                             spans)
 
-# At master, combine all dictionaries of each type into one.
-if rank == 0:
-        
-    # Combine hashtag dictionaries.
-    combined_hashtag_dict = combine_dict(all_hashtag_dicts, int)
+    loop_start = wtime()
+
+    for chunk_data, data_start, data_end in chunks:
+        stats['chunks'] += 1
+        stats['bytes'] += data_end - data_start
+        parse_start = wtime()
+
+        # Locate the rows in the chunk.
+        with stage(spans, 'framing'):
+            rows_start, rows_end = row_span(chunk_data, data_start,
+                                            data_end)
+
+        # Skip chunks without any row, e.g. those inside a very long row.
+        if rows_start == rows_end:
+            continue
+
+        # Count hashtags and languages of the rows...
+        if not args.cache:
+            with stage(spans, 'parse'):
+                row_counts = count_chunk(chunk_data, rows_start, rows_end,
+                                         hashtag_dict, lang_dict)
+
+        # ... or load their counts if the same rows were counted before.
+        else:
+            with stage(spans, 'cache'):
+                with memoryview(chunk_data) as rows_view:
+                    key = cache_key(rows_view[rows_start:rows_end],
+                                    args.parser)
+                counts = load_cached_counts(args.cache, key)
+            if counts is None:
+                counts = (defaultdict(int), defaultdict(int))
+                with stage(spans, 'parse'):
+                    counts += (count_chunk(chunk_data, rows_start, rows_end,
+                                           *counts),)
+                with stage(spans, 'cache'):
+                    store_cached_counts(args.cache, key, counts)
+                stats['cache misses'] += 1
+            else:
+                stats['cache hits'] += 1
+
+            merge_dicts(hashtag_dict, counts[0])
+            merge_dicts(lang_dict, counts[1])
+            row_counts = counts[2]
+
+        stats['rows'] += row_counts[0]
+        stats['dropped rows'] += row_counts[1]
+
+        # Size the next chunk from how fast this one was parsed.
+        if args.memory:
+            sizer.record(data_end - data_start, wtime() - parse_start,
+                         longest_row(chunk_data, rows_start, rows_end))
+
+    if args.memory:
+        stats['largest chunk'] = sizer.largest
+        stats['longest row'] = sizer.longest_row
+
+    stats['busy'] = wtime() - loop_start - stats['idle']
+    stats['hashtags'] = sum(hashtag_dict.values())
+    stats['distinct hashtags'] = len(hashtag_dict)
+
+    # Measure the count tables, and what is allocated while the buffers are
+    # still held, before the merge changes them.
+    if args.memory_report:
+        memory = {'node': platform.node(), 'node memory': node_memory(),
+                  'hashtags': len(hashtag_dict),
+                  'hashtag table': table_size(hashtag_dict),
+                  'lang table': table_size(lang_dict),
+                  'traced': None, 'sites': None}
+        if args.tracemalloc:
+            memory['sites'] = allocation_sites(tracemalloc.take_snapshot(),
+                                               args.tracemalloc)
+
+    # Close the file and free the buffers or mapping after reading.
+    read_file.Close()
+    chunks = chunk_data = None
+    if args.io == 'mmap' and file_size:
+        mapping.close()
+    if args.io == 'pread':
+        chunk_file.Close()
+    if args.schedule == 'dynamic':
+        counter.Free()
+
+    # Time spent waiting for the other workers to finish counts as idle too.
+    wait_start = wtime()
+    with stage(spans, 'barrier'):
+        comm.Barrier()
+    stats['idle'] += wtime() - wait_start
 
-    # Combine language dictionaries.
-    combined_lang_dict = combine_dict(all_lang_dicts, int)
-        
     # The lowest rank to be displayed on scoreboard.
     N = 10
 
-    # Print the top `N` hashtags w/ counts.
-    title = 'Top {0} hashtags.'.format(N)
-    scoreboard(combined_hashtag_dict, N, title, True)
+    merge_start = wtime()
+
+    if args.merge == 'tree':
+
+        # Merge the dictionaries pairwise, ending up at master.
+        counts = tree_reduce(comm, (hashtag_dict, lang_dict), merge_counts)
+        if rank == 0:
+            combined_hashtag_dict, combined_lang_dict = counts
+
+    elif args.merge == 'topk':
+
+        # Only the hashtags that may rank in the top `N` reach the master,
+        # with their exact counts.
+        combined_hashtag_dict = top_counts(comm, hashtag_dict, N)
+
+        # There are few languages, so they are all gathered.
+        all_lang_dicts = comm.gather(lang_dict, root = 0)
+        if rank == 0:
+            combined_lang_dict = combine_dict(all_lang_dicts, int)
+
+    else:
+
+        # Gather the dictionaries from all worker.
+        all_hashtag_dicts = comm.gather(hashtag_dict, root = 0)
+        all_lang_dicts = comm.gather(lang_dict, root = 0)
+
+        # At master, combine all dictionaries of each type into one.
+        if rank == 0:
+
+            # Combine hashtag dictionaries.
+            combined_hashtag_dict = combine_dict(all_hashtag_dicts, int)
+
+            # Combine language dictionaries.
+            combined_lang_dict = combine_dict(all_lang_dicts, int)
+
+    merge_time = wtime() - merge_start
+    if spans is not None:
+        spans.append(('merge', merge_start, merge_start + merge_time))
+    all_stats = comm.gather(stats, root = 0)
+
+    # Hash the blocks of the file that the next incremental run will check,
+    # besides those wholly processed by earlier runs, which were just
+    # checked.
+    if args.incremental:
+        known_blocks = start_offset // STATE_BLOCK
+        new_hashes = block_hashes(comm, args.file_name, end_offset,
+                                  known_blocks)
+
+    comm.Barrier()
+
+    if rank == 0:
+        print('Counts merged in {0:.3f} s ({1}).'.format(merge_time,
+                                                           args.merge))
+
+        # Add the counts of the rows processed by earlier incremental runs
+        # and save them all for the next run.
+        if args.incremental:
+            hashes = new_hashes
+            if state is not None:
+                combined_hashtag_dict = merge_dicts(state[1][0],
+                                                    combined_hashtag_dict)
+                combined_lang_dict = merge_dicts(state[1][1],
+                                                 combined_lang_dict)
+                hashes = state[2][:known_blocks] + new_hashes
+            save_state(state_name, end_offset,
+                       (combined_hashtag_dict, combined_lang_dict), hashes)
+
+        # Save all counts, e.g. to compare runs.
+        if args.counts:
+            with open(args.counts, 'w') as counts_file:
+                json.dump({'hashtags': combined_hashtag_dict,
+                           'languages': combined_lang_dict}, counts_file)
+
+        # Report the adaptive chunk sizes.
+        if args.memory:
+            print('Adaptive chunks: largest {0:.1f} MB, longest row {1} '
+                  'bytes.'.format(
+                  max(stats['largest chunk'] for stats in all_stats)
+                  / 2 ** 20,
+                  int(max(stats['longest row'] for stats in all_stats))))
+
+        # Report cache use and keep the cache within its size.
+        if args.cache:
+            print('Chunk cache: {0} hits, {1} misses.'.format(
+                  int(sum(stats['cache hits'] for stats in all_stats)),
+                  int(sum(stats['cache misses'] for stats in all_stats))))
+            evict_cache(args.cache, args.cache_size * 2 ** 20)
+
+        with stage(spans, 'scoreboard'):
+
+            # Print the top `N` hashtags w/ counts.
+            title = 'Top {0} hashtags.'.format(N)
+            scoreboard(combined_hashtag_dict, N, title, True)
+
+            #Print the top  `N` languages w/ counts.
+            title = 'Top {0} languages.'.format(N)
+            scoreboard(combined_lang_dict, N, title, True, LANG_CODES)
+
+        # Print how the work was shared when it is scheduled dynamically,
+        # and how much waiting for reads is left when they are prefetched.
+        if args.schedule == 'dynamic' or args.prefetch:
+            print_workload(all_stats)
+
+        # Print how much data and work each worker ended up with.
+        print_balance(all_stats)
+
+    # Report the time spent in each stage once the scoreboards are printed,
+    # and write the timeline of every worker, only now so as not to disturb
+    # the run.
+    if spans is not None:
+        all_spans = comm.gather((run_start, spans), root = 0)
+        if rank == 0:
+            if args.timing:
+                print_timing([worker_spans
+                              for _, worker_spans in all_spans],
+                             args.timing_json)
+            if args.trace:
+                write_trace(args.trace, all_spans)
+                print('\nTimeline written to {0}.'.format(args.trace))
+
+    # Report the memory of every worker once it is past its peak.
+    if args.memory_report:
+        memory['peak rss'] = peak_rss()
+        if args.tracemalloc:
+            memory['traced'] = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        all_memory = comm.gather(memory, root = 0)
+        if rank == 0:
+            print_memory(all_memory, table_size(combined_hashtag_dict) +
+                         table_size(combined_lang_dict), args.tracemalloc)
+
+def profile_run(comm, args):
+    ''' 
+    This function does the same as `run` under cProfile, and writes the
+    profile of every worker to a pstats file of its own in
+    `args.profile_dir`. The master then merges them into a summary.
+    '''
+    rank = comm.Get_rank()
+
+    profiler = cProfile.Profile()
+    profiler.runcall(run, comm, args)
+    profile_name = os.path.join(args.profile_dir, PROFILE_NAME.format(rank))
+    profiler.dump_stats(profile_name)
+
+    # The master waits for every profile to be written.
+    profile_names = comm.gather(profile_name, root = 0)
+    if rank == 0:
+        print_profile(profile_names, os.path.join(
+            args.profile_dir, PROFILE_NAME.format('all')))
+
+def main():
+    # Take name of the file to be processed and options from the command
+    # line.
+    args = parse_arguments()
+    worker = profile_run if args.profile else run
+
+    # Workers are the ranks started by mpirun...
+    if args.engine == 'mpi':
+        MPI.Init()
+        worker(MPI.COMM_WORLD, args)
+
+    # ... or the only process...
+    elif args.engine == 'serial':
+        worker(local_comms(1)[0], args)
+
+    # ... or processes started here, one per core by default.
+    else:
+        # The communicators are kept until every worker is done, as under
+        # the spawn start method the workers only pick up their queues and
+        # locks after starting, and they would be freed otherwise.
+        comms = local_comms(args.workers)
+        workers = [multiprocessing.Process(target = worker,
+                                           args = (worker_comm, args))
+                   for worker_comm in comms]
+        for worker in workers:
+            worker.start()
+
+        # Like mpirun, stop every worker as soon as one of them fails, as
+        # the others would wait for it forever.
+        running = list(workers)
+        while running:
+            multiprocessing.connection.wait([worker.sentinel
+                                             for worker in running])
+            for worker in [worker for worker in running
+                           if worker.exitcode is not None]:
+                running.remove(worker)
+                if worker.exitcode != 0:
+                    for other_worker in running:
+                        other_worker.terminate()
+                    sys.exit(1)
+        del comms
 
-    #Print the top  `N` languages w/ counts.
-    title = 'Top {0} languages.'.format(N)
-    scoreboard(combined_lang_dict, N, title, True, LANG_CODES)
+if __name__ == '__main__':
+    main()
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,64 @@
+# -----------------------------------------------------------------------------
+# COMP90024 Cluster and Cloud Computing Semester 1, 2020 - Assignment 1
+# Microbenchmark of the batched hashtag extractor against the per-tweet one.
+# -----------------------------------------------------------------------------
+
+import argparse
+import random
+
+from assignment1mpi import hashtags_from_text, hashtags_from_texts
+from bench_stages import best_time
+
+# Words sample texts are made of, with a few non-ASCII ones.
+WORDS = ['the', 'fire', 'smoke', 'Sydney', 'rain', 'today', 'héllo', '日本',
+         'https://t.co/x1y2z3', '@user', 'RT', '...', '…', '😀']
+
+# Hashtags sample texts are made of, with non-ASCII and mixed case ones.
+HASHTAGS = ['#auspol', '#AusPol', '#ClimateChange', '#COVID19', '#nswfires',
+            '#Bushfire_Crisis', '#日本', '#café', '#sonicmovie', '#a1…']
+
+# -----------------------------------------------------------------------------
+
+def sample_texts(count, seed = 0):
+    '''
+    This function return `count` tweet-like texts, most of them without any
+    hashtag, as a list of strings.
+    '''
+    generator = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        words = generator.choices(WORDS, k = generator.randint(3, 20))
+        if generator.random() < 0.3:
+            words += generator.choices(HASHTAGS, k = generator.randint(1, 4))
+            generator.shuffle(words)
+        texts.append(' '.join(words))
+
+    return texts
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Compare the per-tweet and batched hashtag extractors.')
+    parser.add_argument('--texts', type = int, default = 1000000,
+                        help = 'number of sample texts.')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'number of runs, the best one is reported.')
+    args = parser.parse_args()
+
+    texts = sample_texts(args.texts)
+    utf8_texts = [text.encode('utf-8') for text in texts]
+
+    baseline, expected = best_time(
+        lambda: [hashtags_from_text(text) for text in texts], args.repeat)
+    print('{0:>16}: {1:.3f} s, {2:.0f} texts/s.'.format(
+          'per tweet', baseline, args.texts / baseline))
+
+    for name, batch in (('batch (str)', texts), ('batch (bytes)', utf8_texts)):
+        elapsed, result = best_time(lambda: hashtags_from_texts(batch),
+                                    args.repeat)
+        print('{0:>16}: {1:.3f} s, {2:.0f} texts/s, {3:.2f}x{4}.'.format(
+              name, elapsed, args.texts / elapsed, baseline / elapsed,
+              '' if result == expected else ', DIFFERENT RESULTS'))
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,111 @@
+# -----------------------------------------------------------------------------
+# COMP90024 Cluster and Cloud Computing Semester 1, 2020 - Assignment 1
+# Benchmark of collective reads against independent MPI-IO and plain reads,
+# each worker reading and counting its share of the file as assignment1mpi.py
+# does. Run with e.g. `mpirun -n 8 python3 bench_io.py bigTwitter.json`, on
+# 1 node with 8 cores and on 2 nodes with 4 cores each.
+# -----------------------------------------------------------------------------
+
+import argparse
+from collections import defaultdict
+from mpi4py import MPI
+
+from assignment1mpi import (LocalFile, row_boundary, row_ranges, read_chunks,
+                            row_span, count_rows)
+
+comm = MPI.COMM_WORLD
+size = comm.Get_size()
+rank = comm.Get_rank()
+
+# -----------------------------------------------------------------------------
+
+def count_nodes():
+    '''
+    This function return the number of nodes the ranks are spread over.
+    '''
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    nodes = comm.allreduce(int(node_comm.Get_rank() == 0))
+    node_comm.Free()
+
+    return nodes
+
+def time_io(file_name, io, prefetch, chunk_num):
+    '''
+    This function reads and counts the share of the file of this rank with
+    reads of the kind given by `io`. Returns the time taken until every rank
+    is done, the time this rank took and the time it spent waiting for
+    reads.
+    '''
+    comm.Barrier()
+    start = MPI.Wtime()
+
+    read_file = MPI.File.Open(comm, file_name, MPI.MODE_RDONLY)
+    file_size = read_file.Get_size()
+    worker_start = row_boundary(read_file, file_size * rank // size,
+                                file_size)
+    worker_end = row_boundary(read_file, file_size * (rank + 1) // size,
+                              file_size)
+    chunk_ranges = row_ranges(read_file, file_size, worker_start, worker_end,
+                              chunk_num)
+
+    chunk_file = LocalFile(file_name) if io == 'pread' else read_file
+    stats = defaultdict(float)
+    hashtag_dict = defaultdict(int)
+    lang_dict = defaultdict(int)
+    for chunk_data, data_start, data_end in read_chunks(
+            chunk_file, chunk_ranges,
+            max([chunk_end - chunk_start
+                 for chunk_start, chunk_end in chunk_ranges]),
+            io == 'collective', prefetch, stats):
+        rows_start, rows_end = row_span(chunk_data, data_start, data_end)
+        count_rows(chunk_data, rows_start, rows_end, hashtag_dict, lang_dict)
+
+    if io == 'pread':
+        chunk_file.Close()
+    read_file.Close()
+    worker_time = MPI.Wtime() - start
+
+    # A pass is over once every rank is done.
+    comm.Barrier()
+    return MPI.Wtime() - start, worker_time, stats['io wait']
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Compare collective, independent and plain reads.')
+    parser.add_argument('file_name', help = 'json file to be processed.')
+    parser.add_argument('--prefetch', action = 'store_true',
+                        help = 'read the next chunk while the current one is '
+                               'counted.')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'number of runs, the best one is reported.')
+    args = parser.parse_args()
+
+    chunk_num = 128 if size < 2 else 32
+    nodes = count_nodes()
+
+    if rank == 0:
+        print('{0} ranks on {1} node(s), {2} chunks per rank{3}.\n'.format(
+              size, nodes, chunk_num, ', prefetching' if args.prefetch
+              else ''))
+        print('{0:>12} {1:>10} {2:>14} {3:>14} {4:>14}'.format(
+              'I/O', 'Total (s)', 'Fastest (s)', 'Slowest (s)',
+              'I/O wait (s)'))
+
+    for io in ('collective', 'independent', 'pread'):
+        best = None
+        for _ in range(args.repeat):
+            result = time_io(args.file_name, io, args.prefetch, chunk_num)
+            if best is None or result[0] < best[0]:
+                best = result
+
+        # Spread of the ranks' own times, and their mean wait for reads.
+        worker_times = comm.gather(best[1], root = 0)
+        io_wait = comm.reduce(best[2], root = 0)
+        if rank == 0:
+            print('{0:>12} {1:>10.3f} {2:>14.3f} {3:>14.3f} {4:>14.3f}'.format(
+                  io, best[0], min(worker_times), max(worker_times),
+                  io_wait / size))
+
+# -----------------------------------------------------------------------------
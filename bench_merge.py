@@ -0,0 +1,130 @@
+# -----------------------------------------------------------------------------
+# COMP90024 Cluster and Cloud Computing Semester 1, 2020 - Assignment 1
+# Benchmark of gathering counts at the master against merging them along a
+# binomial tree and against the distributed top N of hashtags.
+# Run with e.g. `mpirun -n 8 python3 bench_merge.py`.
+# -----------------------------------------------------------------------------
+
+import argparse
+import random
+from collections import defaultdict
+from mpi4py import MPI
+
+from assignment1mpi import combine_dict, merge_counts, tree_reduce, top_counts
+
+comm = MPI.COMM_WORLD
+size = comm.Get_size()
+rank = comm.Get_rank()
+
+# -----------------------------------------------------------------------------
+
+def random_counts(keys, vocabulary, seed):
+    '''
+    This function return a hashtag and a language int defaultdict holding
+    `keys` draws each, with hashtags drawn from a long-tailed distribution
+    over `vocabulary` distinct hashtags.
+    '''
+    generator = random.Random(seed)
+    hashtag_dict = defaultdict(int)
+    lang_dict = defaultdict(int)
+    for _ in range(keys):
+        hashtag_dict['#tag' + str(int(vocabulary ** generator.random()))] += 1
+        lang_dict['lang' + str(int(60 ** generator.random()))] += 1
+
+    return hashtag_dict, lang_dict
+
+def time_gather(hashtag_dict, lang_dict):
+    '''
+    This function gathers the counts at rank 0 and combines them there, as
+    assignment1mpi.py does by default. Returns the time taken and the result.
+    '''
+    comm.Barrier()
+    start = MPI.Wtime()
+
+    all_hashtag_dicts = comm.gather(hashtag_dict, root = 0)
+    all_lang_dicts = comm.gather(lang_dict, root = 0)
+    counts = None
+    if rank == 0:
+        counts = (combine_dict(all_hashtag_dicts, int),
+                  combine_dict(all_lang_dicts, int))
+
+    return MPI.Wtime() - start, counts
+
+def time_tree(hashtag_dict, lang_dict):
+    '''
+    This function merges the counts along a binomial tree. Returns the time
+    taken and the result.
+    '''
+    comm.Barrier()
+    start = MPI.Wtime()
+
+    counts = tree_reduce(comm, (hashtag_dict, lang_dict), merge_counts)
+
+    return MPI.Wtime() - start, counts
+
+def time_topk(hashtag_dict, lang_dict, n = 10):
+    '''
+    This function finds the top `n` hashtags without sending whole hashtag
+    dictionaries, and gathers the languages. Returns the time taken and the
+    result, which only holds the hashtags that may rank in the top `n`.
+    '''
+    comm.Barrier()
+    start = MPI.Wtime()
+
+    top_hashtag_dict = top_counts(comm, hashtag_dict, n)
+    all_lang_dicts = comm.gather(lang_dict, root = 0)
+    counts = None
+    if rank == 0:
+        counts = (top_hashtag_dict, combine_dict(all_lang_dicts, int))
+
+    return MPI.Wtime() - start, counts
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Compare the gather, tree and top N merges of counts.')
+    parser.add_argument('--keys', type = int, default = 200000,
+                        help = 'number of hashtags counted by each rank.')
+    parser.add_argument('--vocabulary', type = int, default = 1000000,
+                        help = 'number of distinct hashtags.')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'number of runs, the best one is reported.')
+    args = parser.parse_args()
+
+    results = {}
+    for name, time_merge in (('gather', time_gather), ('tree', time_tree),
+                             ('topk', time_topk)):
+        best = None
+        for _ in range(args.repeat):
+
+            # Merging modifies the counts, so each run gets fresh ones.
+            hashtag_dict, lang_dict = random_counts(args.keys,
+                                                    args.vocabulary, rank)
+            elapsed, counts = time_merge(hashtag_dict, lang_dict)
+
+            # A merge is over once rank 0 has the result.
+            elapsed = comm.bcast(elapsed, root = 0)
+            if best is None or elapsed < best:
+                best = elapsed
+
+        results[name] = (best, counts)
+
+    if rank == 0:
+        hashtag_totals = results['gather'][1][0]
+        if results['tree'][1] != results['gather'][1]:
+            print('WARNING: the tree and gather merges found different '
+                  'counts.')
+        if any(hashtag_totals[key] != value
+               for key, value in results['topk'][1][0].items()):
+            print('WARNING: the top N and gather merges found different '
+                  'counts.')
+        print('{0:>6} {1:>12} {2:>10} {3:>10} {4:>10} {5:>12}'.format(
+              'Ranks', 'Keys', 'Gather (s)', 'Tree (s)', 'Top N (s)',
+              'Top N keys'))
+        print('{0:>6} {1:>12} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>12}'.format(
+              size, len(hashtag_totals), results['gather'][0],
+              results['tree'][0], results['topk'][0],
+              len(results['topk'][1][0])))
+
+# -----------------------------------------------------------------------------
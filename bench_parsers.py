@@ -0,0 +1,108 @@
+# -----------------------------------------------------------------------------
+# COMP90024 Cluster and Cloud Computing Semester 1, 2020 - Assignment 1
+# Benchmark of the row-at-a-time parsers against the ijson event loop.
+# -----------------------------------------------------------------------------
+
+import argparse
+import time
+import functools
+from collections import defaultdict
+from mpi4py import MPI
+
+from assignment1mpi import (row_boundary, row_ranges, row_span, count_rows,
+                            count_rows_ijson)
+
+# -----------------------------------------------------------------------------
+
+def read_partition(file_name, worker, workers, chunk_num):
+    '''
+    This function reads the share of the file that worker `worker` out of
+    `workers` would be assigned by assignment1mpi.py and return its chunks as
+    a list of bytearrays, each holding whole rows only.
+    '''
+    read_file = MPI.File.Open(MPI.COMM_SELF, file_name, MPI.MODE_RDONLY)
+    file_size = read_file.Get_size()
+
+    worker_start = row_boundary(read_file, file_size * worker // workers,
+                                file_size)
+    worker_end = row_boundary(read_file, file_size * (worker + 1) // workers,
+                              file_size)
+
+    chunks = []
+    for chunk_start, chunk_end in row_ranges(read_file, file_size,
+                                             worker_start, worker_end,
+                                             chunk_num):
+        chunk_buffer = bytearray(chunk_end - chunk_start)
+        read_file.Read_at(chunk_start, chunk_buffer)
+        chunks.append(chunk_buffer)
+
+    read_file.Close()
+    return chunks
+
+def time_engine(count_chunk, chunks, repeat):
+    '''
+    This function runs `count_chunk` over every chunk `repeat` times and
+    return the best time in seconds along with the counts found.
+    '''
+    best = None
+    for _ in range(repeat):
+        hashtag_dict = defaultdict(int)
+        lang_dict = defaultdict(int)
+
+        started = time.perf_counter()
+        for chunk_buffer in chunks:
+            rows_start, rows_end = row_span(chunk_buffer, 0,
+                                            len(chunk_buffer))
+            count_chunk(chunk_buffer, rows_start, rows_end, hashtag_dict,
+                        lang_dict)
+        elapsed = time.perf_counter() - started
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, hashtag_dict, lang_dict
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Compare the parsers on one partition.')
+    parser.add_argument('file_name', help = 'json file to be processed.')
+    parser.add_argument('--worker', type = int, default = 0,
+                        help = 'worker whose partition is parsed.')
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'number of workers the file is split between.')
+    parser.add_argument('--chunks', type = int, default = 32,
+                        help = 'number of chunks per worker.')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'number of runs, the best one is reported.')
+    args = parser.parse_args()
+
+    chunks = read_partition(args.file_name, args.worker, args.workers,
+                            args.chunks)
+    megabytes = sum(len(chunk_buffer) for chunk_buffer in chunks) / 2 ** 20
+    print('Partition {0} of {1}: {2:.1f} MB in {3} chunks.\n'.format(
+          args.worker, args.workers, megabytes, len(chunks)))
+
+    results = {}
+    for name, count_chunk in (
+            ('ijson', count_rows_ijson),
+            ('rows', functools.partial(count_rows, targeted = False)),
+            ('fields', count_rows)):
+        elapsed, hashtag_dict, lang_dict = time_engine(count_chunk, chunks,
+                                                       args.repeat)
+        results[name] = (elapsed, hashtag_dict, lang_dict)
+        print('{0:>6}: {1:.3f} s, {2:.1f} MB/s, {3} tweets.'.format(
+              name, elapsed, megabytes / elapsed, sum(lang_dict.values())))
+
+    # All engines must agree before their speed can be compared.
+    print()
+    for name in ('rows', 'fields'):
+        if results[name][1:] != results['ijson'][1:]:
+            print('WARNING: {0} and ijson found different counts.'.format(
+                  name))
+        else:
+            print('Speedup of {0} over ijson: {1:.2f}x.'.format(
+                  name, results['ijson'][0] / results[name][0]))
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,235 @@
+# -----------------------------------------------------------------------------
+# COMP90024 Cluster and Cloud Computing Semester 1, 2020 - Assignment 1
+# Strong and weak scaling of assignment1mpi.py over a list of rank counts,
+# run with a local mpirun. Every configuration is first checked to find the
+# same counts, then timed, and an Amdahl (strong) or Gustafson (weak) serial
+# fraction is fitted to the speedups.
+# -----------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_stages import generate_dump
+
+# Directory of the program, which it is run from to find the language codes.
+PROGRAM_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# -----------------------------------------------------------------------------
+
+def run_program(mpirun, ranks, file_name, extra_args, counts_name = None):
+    '''
+    This function runs assignment1mpi.py on `file_name` with `ranks` ranks,
+    or in a single process with the serial engine if `mpirun` is `None`,
+    and return the wall time in seconds. All counts are saved to
+    `counts_name` if given. Exits if the program fails.
+    '''
+    command = [sys.executable, 'assignment1mpi.py', file_name] + extra_args
+    if mpirun is None:
+        command += ['--engine', 'serial']
+    else:
+        command = mpirun + ['-n', str(ranks)] + command
+    if counts_name is not None:
+        command += ['--counts', counts_name]
+
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd = PROGRAM_DIR,
+                            stdout = subprocess.DEVNULL,
+                            stderr = subprocess.PIPE)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        sys.exit('{0} failed:\n{1}'.format(' '.join(command),
+                                            result.stderr.decode()))
+
+    return elapsed
+
+def load_counts(counts_name):
+    '''
+    This function return the hashtag and language counts saved by a run.
+    '''
+    with open(counts_name) as counts_file:
+        counts = json.load(counts_file)
+
+    return counts['hashtags'], counts['languages']
+
+def check_counts(mpirun, configurations, extra_args, weak, work_dir):
+    '''
+    This function runs every (ranks, file name) configuration once and
+    checks that it finds the same counts as the first one, or, for weak
+    scaling where every file differs, as a single process run on the same
+    file. Return `True` if they all agree.
+    '''
+    counts_name = os.path.join(work_dir, 'counts.json')
+    expected = None
+    agree = True
+    for ranks, file_name in configurations:
+        run_program(mpirun, ranks, file_name, extra_args, counts_name)
+        counts = load_counts(counts_name)
+        if weak:
+            run_program(None, 1, file_name, extra_args, counts_name)
+            expected = load_counts(counts_name)
+        elif expected is None:
+            expected = counts
+
+        same = counts == expected
+        agree = agree and same
+        print('{0:>6} ranks: {1}.'.format(ranks, 'same counts' if same
+                                          else 'DIFFERENT COUNTS'))
+
+    return agree
+
+def fit_serial_fraction(ranks, times, speedups, weak):
+    '''
+    This function fits the serial fraction f of Amdahl's law to the
+    measured times, T(n) = T(1) (f + (1 - f) / n), or if `weak` that of
+    Gustafson's law to the speedups over 1 rank, S = n - f (n - 1), by
+    least squares, and return it. Returns `None` if it cannot be fitted,
+    e.g. for weak scaling without a run on 1 rank.
+    '''
+
+    # Gustafson's law is linear in f: n - S = f (n - 1).
+    if weak:
+        if ranks[0] != 1:
+            return None
+        points = [(n - 1, n - speedup) for n, speedup in zip(ranks, speedups)]
+        denominator = sum(x * x for x, _ in points)
+        if denominator == 0:
+            return None
+        return sum(x * y for x, y in points) / denominator
+
+    # Amdahl's law is linear in 1 / n: T(n) = a + b / n, where a = T(1) f
+    # and b = T(1) (1 - f), whichever rank count the runs start from.
+    points = [(1 / n, elapsed) for n, elapsed in zip(ranks, times)]
+    count = len(points)
+    sum_x = sum(x for x, _ in points)
+    sum_y = sum(y for _, y in points)
+    denominator = count * sum(x * x for x, _ in points) - sum_x ** 2
+    if denominator == 0:
+        return None
+    b = (count * sum(x * y for x, y in points) - sum_x * sum_y) / denominator
+    a = (sum_y - b * sum_x) / count
+    if a + b == 0:
+        return None
+
+    return a / (a + b)
+
+def print_scaling(title, ranks, times, weak):
+    '''
+    This function prints the time, speedup and efficiency of every rank
+    count, relative to the first one, along with the fitted serial
+    fraction, and return them as a dict.
+    '''
+    speedups = [times[0] / elapsed * (n / ranks[0] if weak else 1)
+                for n, elapsed in zip(ranks, times)]
+    efficiencies = [speedup / n * ranks[0]
+                    for n, speedup in zip(ranks, speedups)]
+    serial_fraction = fit_serial_fraction(ranks, times, speedups, weak)
+
+    print('\n' + title + '\n')
+    print('{0:>6} {1:>10} {2:>10} {3:>12}'.format('Ranks', 'Time (s)',
+                                                  'Speedup', 'Efficiency'))
+    for n, elapsed, speedup, efficiency in zip(ranks, times, speedups,
+                                               efficiencies):
+        print('{0:>6} {1:>10.3f} {2:>10.2f} {3:>11.0%}'.format(
+              n, elapsed, speedup, efficiency))
+    if serial_fraction is not None:
+        print('\n{0} serial fraction: {1:.3f}{2}.'.format(
+              'Gustafson' if weak else 'Amdahl', serial_fraction,
+              '' if 0 <= serial_fraction <= 1 else
+              ', outside [0, 1]: the runs do not follow the law'))
+    elif weak and ranks[0] != 1:
+        print('\nGustafson serial fraction: needs a run on 1 rank.')
+
+    return {'ranks': ranks, 'seconds': times, 'speedups': speedups,
+            'efficiencies': efficiencies,
+            'serial_fraction': serial_fraction}
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Measure strong and weak scaling of the program.')
+    parser.add_argument('file_name', nargs = '?',
+                        help = 'json file processed for strong scaling.')
+    parser.add_argument('--ranks', type = int, nargs = '+',
+                        default = [1, 2, 4, 8],
+                        help = 'rank counts to run with (default: 1 2 4 8).')
+    parser.add_argument('--mpirun', default = 'mpirun',
+                        help = 'command starting the ranks, e.g. '
+                               '"mpirun --oversubscribe".')
+    parser.add_argument('--args', default = '',
+                        help = 'extra arguments of the program, e.g. '
+                               '"--io independent".')
+    parser.add_argument('--weak-rows', type = int, default = 0,
+                        metavar = 'ROWS',
+                        help = 'also measure weak scaling on synthetic dumps '
+                               'of ROWS tweets per rank.')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'number of runs, the best one is reported.')
+    parser.add_argument('--output', metavar = 'JSON',
+                        help = 'save the results to this json file.')
+    args = parser.parse_args()
+
+    if args.file_name is None and not args.weak_rows:
+        parser.error('give a file for strong scaling and/or --weak-rows.')
+
+    mpirun = shlex.split(args.mpirun)
+    extra_args = shlex.split(args.args)
+    ranks = sorted(set(args.ranks))
+
+    # Counts are compared through --counts, which the top N merge refuses as
+    # it does not gather all of them.
+    merges = [value for option, value in zip(extra_args, extra_args[1:])
+              if option == '--merge']
+    merges += [argument.split('=', 1)[1] for argument in extra_args
+               if argument.startswith('--merge=')]
+    if 'topk' in merges:
+        parser.error('--merge topk does not save all counts, so runs cannot '
+                     'be checked; use gather or tree.')
+
+    with tempfile.TemporaryDirectory() as work_dir:
+
+        # Strong scaling processes the same file with every rank count, and
+        # weak scaling a file growing with the ranks.
+        experiments = []
+        if args.file_name:
+            experiments.append(('Strong scaling', False,
+                                [(n, os.path.abspath(args.file_name))
+                                 for n in ranks]))
+        if args.weak_rows:
+            configurations = []
+            for n in ranks:
+                file_name = os.path.join(work_dir, 'weak{0}.json'.format(n))
+                generate_dump(file_name, args.weak_rows * n, 100000, 20, 1.1)
+                configurations.append((n, file_name))
+            experiments.append(('Weak scaling, {0} rows per rank'.format(
+                                args.weak_rows), True, configurations))
+
+        # No time is worth reporting unless all configurations agree.
+        for title, weak, configurations in experiments:
+            print('Checking counts, ' + title[0].lower() + title[1:] + '.')
+            if not check_counts(mpirun, configurations, extra_args, weak,
+                                work_dir):
+                sys.exit('Configurations found different counts.')
+
+        results = {}
+        for title, weak, configurations in experiments:
+            times = [min(run_program(mpirun, n, file_name, extra_args)
+                         for _ in range(args.repeat))
+                     for n, file_name in configurations]
+            results['weak' if weak else 'strong'] = print_scaling(
+                title + '.', ranks, times, weak)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'arguments': vars(args), 'scaling': results},
+                      output_file, indent = 2)
+        print('\nResults saved to {0}.'.format(args.output))
+
+# -----------------------------------------------------------------------------
@@ -0,0 +1,362 @@
+# -----------------------------------------------------------------------------
+# COMP90024 Cluster and Cloud Computing Semester 1, 2020 - Assignment 1
+# Benchmark of each stage of assignment1mpi.py in isolation, on a synthetic
+# CouchDB dump of tweets with Zipf distributed hashtags and languages.
+# Results are printed in MB/s and rows/s and may be saved as json, so that
+# runs can be compared over time.
+# -----------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import time
+import ijson
+from collections import defaultdict
+
+from assignment1mpi import (LocalFile, row_ranges, read_chunks, row_span,
+                            frame_rows, extract_fields, hashtags_from_text,
+                            hashtags_from_texts, count_rows, count_rows_ijson,
+                            combine_dict, scoreboard)
+
+# Language codes drawn for the tweets, the most common first.
+LANG_CODES = ['en', 'ja', 'es', 'in', 'pt', 'th', 'und', 'fr', 'ar', 'ko',
+              'tl', 'de', 'it', 'tr', 'ru', 'nl', 'hi', 'zh', 'pl', 'sv']
+
+# Words tweets are made of, besides hashtags.
+WORDS = ['the', 'fire', 'smoke', 'Sydney', 'rain', 'today', 'héllo', '日本',
+         'https://t.co/x1y2z3', '@user', 'RT', '"quoted"', '…', '😀']
+
+# ijson backends tried, for versions of ijson which do not list them.
+IJSON_BACKENDS = ('yajl2_c', 'yajl2_cffi', 'yajl2', 'python')
+
+# Sidecar file holding the parameters a dump was generated with.
+PARAMETERS_SUFFIX = '.params.json'
+
+# -----------------------------------------------------------------------------
+
+def zipf_weights(count, exponent):
+    '''
+    This function return the weights of `count` ranks under Zipf's law with
+    the given exponent, the first rank being the most likely.
+    '''
+    return [1 / rank ** exponent for rank in range(1, count + 1)]
+
+def generate_dump(file_name, rows, hashtags, langs, exponent, seed = 0):
+    '''
+    This function writes a CouchDB dump of `rows` tweets to `file_name`, one
+    row per line, with hashtags drawn from `hashtags` distinct ones and
+    languages from the `langs` most common ones, both Zipf distributed.
+    '''
+    generator = random.Random(seed)
+    hashtag_names = ['#tag{0}'.format(rank) if rank % 5 else
+                     '#Tag{0}'.format(rank) for rank in range(hashtags)]
+    hashtag_weights = zipf_weights(hashtags, exponent)
+    lang_codes = LANG_CODES[:langs]
+    lang_weights = zipf_weights(len(lang_codes), exponent)
+
+    with open(file_name, 'w', encoding = 'utf-8') as dump_file:
+        dump_file.write('{{"total_rows":{0},"offset":0,"rows":[\n'.format(
+                        rows))
+        for row in range(rows):
+            words = generator.choices(WORDS, k = generator.randint(3, 20))
+            if generator.random() < 0.4:
+                words += generator.choices(hashtag_names, hashtag_weights,
+                                           k = generator.randint(1, 4))
+                generator.shuffle(words)
+            doc = {'_id': str(row), '_rev': '1-' + str(row),
+                   'created_at': 'Thu Feb 20 02:00:00 +0000 2020',
+                   'id': row, 'text': ' '.join(words),
+                   'user': {'id': generator.randint(1, 10 ** 6),
+                            'description': ' '.join(generator.choices(
+                                WORDS + hashtag_names[:10], k = 10))},
+                   'metadata': {'iso_language_code': generator.choices(
+                                    lang_codes, lang_weights)[0],
+                                'result_type': 'recent'}}
+            dump_file.write(json.dumps({'id': str(row), 'key': str(row),
+                                        'value': {'rev': doc['_rev']},
+                                        'doc': doc},
+                                       ensure_ascii = bool(row % 2),
+                                       separators = (',', ':')))
+            dump_file.write(',\n' if row < rows - 1 else '\n')
+        dump_file.write(']}\n')
+
+def load_parameters(file_name):
+    '''
+    This function return the parameters `file_name` was generated with, as
+    saved next to it, or `None` if it was not generated here.
+    '''
+    try:
+        with open(file_name + PARAMETERS_SUFFIX) as parameters_file:
+            return json.load(parameters_file)
+    except (OSError, ValueError):
+        return None
+
+def prepare_dump(file_name, parameters):
+    '''
+    This function generates a dump with the given parameters, unless one
+    generated with the same parameters exists already, and saves them next
+    to it. A dump that was not generated here is used as is. Returns the
+    parameters of the dump, or `None` if they are unknown.
+    '''
+    saved = load_parameters(file_name)
+    if os.path.exists(file_name) and saved is None:
+        print('Using {0} as is.'.format(file_name))
+        return None
+    if os.path.exists(file_name) and saved == parameters:
+        return saved
+
+    print('Generating {0}...'.format(file_name))
+    generate_dump(file_name, parameters['rows'], parameters['hashtags'],
+                  parameters['langs'], parameters['zipf'],
+                  parameters['seed'])
+    with open(file_name + PARAMETERS_SUFFIX, 'w') as parameters_file:
+        json.dump(parameters, parameters_file)
+
+    return parameters
+
+def file_digest(file_name):
+    '''
+    This function return the BLAKE2b hash of a file, which tells whether
+    two reports timed the same dump.
+    '''
+    digest = hashlib.blake2b()
+    with open(file_name, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(2 ** 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def best_time(function, repeat):
+    '''
+    This function calls `function` `repeat` times and return the best time in
+    seconds along with the result of the last call.
+    '''
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+def read_all(file_name, chunk_ranges, buffer_size):
+    '''
+    This function reads every chunk of `chunk_ranges` as assignment1mpi.py
+    does and return them as a list of bytes.
+    '''
+    read_file = LocalFile(file_name)
+    chunks = [bytes(chunk_data[data_start:data_end])
+              for chunk_data, data_start, data_end in read_chunks(
+                  read_file, chunk_ranges, buffer_size, False, False,
+                  defaultdict(float))]
+    read_file.Close()
+
+    return chunks
+
+def frame_all(chunks):
+    '''
+    This function locates the rows of every chunk and wraps them as json
+    documents, as the ijson parser does. Returns the documents.
+    '''
+    documents = []
+    for chunk_data in chunks:
+        rows_start, rows_end = row_span(chunk_data, 0, len(chunk_data))
+        documents.append(frame_rows(memoryview(chunk_data), rows_start,
+                                    rows_end))
+
+    return documents
+
+def parse_all(backend, documents):
+    '''
+    This function streams every document through the event parser of an
+    ijson backend and return the number of events.
+    '''
+    events = 0
+    for document in documents:
+        for _ in backend.parse(io.BytesIO(document)):
+            events += 1
+
+    return events
+
+def count_all(count_chunk, chunks):
+    '''
+    This function counts the hashtags and languages of every chunk with
+    `count_chunk` and return the hashtag and language dictionaries.
+    '''
+    hashtag_dict = defaultdict(int)
+    lang_dict = defaultdict(int)
+    for chunk_data in chunks:
+        rows_start, rows_end = row_span(chunk_data, 0, len(chunk_data))
+        count_chunk(chunk_data, rows_start, rows_end, hashtag_dict, lang_dict)
+
+    return hashtag_dict, lang_dict
+
+def split_rows(chunks):
+    '''
+    This function return every row of the chunks as bytes, without the comma
+    ending it.
+    '''
+    rows = []
+    for chunk_data in chunks:
+        rows_start, rows_end = row_span(chunk_data, 0, len(chunk_data))
+        rows += [row.rstrip().rstrip(b',')
+                 for row in chunk_data[rows_start:rows_end].split(b'\n')]
+
+    return rows
+
+def split_counts(counts, parts):
+    '''
+    This function deals the keys of a dictionary of counts out to `parts`
+    dictionaries, as if they were counted by as many workers, and return
+    them as a list.
+    '''
+    all_counts = [defaultdict(int) for _ in range(parts)]
+    for position, (key, value) in enumerate(counts.items()):
+        all_counts[position % parts][key] += value
+
+    return all_counts
+
+def print_scoreboards(hashtag_dict, lang_dict):
+    '''
+    This function prints the top 10 hashtags and languages to nowhere.
+    '''
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull):
+        scoreboard(hashtag_dict, 10, 'Top 10 hashtags.', True)
+        scoreboard(lang_dict, 10, 'Top 10 languages.', True)
+
+def ijson_backends():
+    '''
+    This function return the name and module of every ijson backend that
+    can be loaded here.
+    '''
+    backends = []
+    for name in getattr(ijson, 'ALL_BACKENDS', IJSON_BACKENDS):
+        try:
+            backends.append((name, ijson.get_backend(name)))
+        except ImportError:
+            pass
+
+    return backends
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Time each stage of the program on a synthetic dump.')
+    parser.add_argument('--file-name', default = 'benchTwitter.json',
+                        help = 'dump to generate, again if it was generated '
+                               'with other parameters, or to use as is if '
+                               'it was not generated here.')
+    parser.add_argument('--rows', type = int, default = 200000,
+                        help = 'number of tweets generated.')
+    parser.add_argument('--hashtags', type = int, default = 100000,
+                        help = 'number of distinct hashtags generated.')
+    parser.add_argument('--langs', type = int, default = len(LANG_CODES),
+                        help = 'number of distinct languages generated.')
+    parser.add_argument('--zipf', type = float, default = 1.1,
+                        help = 'exponent of the Zipf distribution of '
+                               'hashtags and languages.')
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'seed of the generator.')
+    parser.add_argument('--chunks', type = int, default = 32,
+                        help = 'number of chunks the dump is read in.')
+    parser.add_argument('--workers', type = int, default = 8,
+                        help = 'number of workers the counts are combined '
+                               'from.')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'number of runs, the best one is reported.')
+    parser.add_argument('--output', metavar = 'JSON',
+                        help = 'save the results to this json file.')
+    args = parser.parse_args()
+
+    parameters = prepare_dump(args.file_name,
+                              {'rows': args.rows, 'hashtags': args.hashtags,
+                               'langs': args.langs, 'zipf': args.zipf,
+                               'seed': args.seed})
+
+    file_size = os.path.getsize(args.file_name)
+    read_file = LocalFile(args.file_name)
+    chunk_ranges = row_ranges(read_file, file_size, 0, file_size,
+                              args.chunks)
+    read_file.Close()
+    buffer_size = max([chunk_end - chunk_start
+                       for chunk_start, chunk_end in chunk_ranges])
+
+    chunks = read_all(args.file_name, chunk_ranges, buffer_size)
+    documents = frame_all(chunks)
+    all_rows = split_rows(chunks)
+    texts = [json.loads(row)['doc']['text'] for row in all_rows]
+    rows = len(all_rows)
+    megabytes = file_size / 2 ** 20
+    print('{0}: {1:.1f} MB, {2} rows, {3} chunks.\n'.format(
+          args.file_name, megabytes, rows, len(chunks)))
+
+    # Each stage is timed on the output of the previous ones.
+    stages = [('read', lambda: read_all(args.file_name, chunk_ranges,
+                                        buffer_size)),
+              ('framing', lambda: frame_all(chunks))]
+    for name, backend in ijson_backends():
+        stages.append(('parse ijson ' + name,
+                       functools.partial(parse_all, backend, documents)))
+    stages += [('extract fields',
+                lambda: [extract_fields(row) for row in all_rows]),
+               ('hashtags_from_text',
+                lambda: [hashtags_from_text(text) for text in texts]),
+               ('hashtags_from_texts', lambda: hashtags_from_texts(texts)),
+               ('count fields', lambda: count_all(count_rows, chunks)),
+               ('count rows', lambda: count_all(
+                   functools.partial(count_rows, targeted = False), chunks)),
+               ('count ijson', lambda: count_all(count_rows_ijson, chunks))]
+
+    results = {}
+    print('{0:>24} {1:>10} {2:>10} {3:>12}'.format('Stage', 'Time (s)',
+                                                   'MB/s', 'Rows/s'))
+    for name, stage in stages:
+        elapsed, result = best_time(stage, args.repeat)
+        results[name] = {'seconds': elapsed, 'mb_per_s': megabytes / elapsed,
+                         'rows_per_s': rows / elapsed}
+        print('{0:>24} {1:>10.3f} {2:>10.1f} {3:>12.0f}'.format(
+              name, elapsed, megabytes / elapsed, rows / elapsed))
+
+    # Merging and printing are timed on the counts, whose size does not
+    # depend on the size of the dump but on the number of distinct keys.
+    hashtag_dict, lang_dict = count_all(count_rows, chunks)
+    for name, stage in (
+            ('combine_dict', lambda: combine_dict(
+                split_counts(hashtag_dict, args.workers), int)),
+            ('scoreboard', lambda: print_scoreboards(hashtag_dict,
+                                                     lang_dict))):
+        elapsed, result = best_time(stage, args.repeat)
+        results[name] = {'seconds': elapsed,
+                         'keys_per_s': len(hashtag_dict) / elapsed}
+        print('{0:>24} {1:>10.3f} {2:>10} {3:>12}'.format(
+              name, elapsed, '-', '-'))
+    print('\n{0} distinct hashtags, {1} languages.'.format(len(hashtag_dict),
+                                                           len(lang_dict)))
+
+    if args.output:
+        report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': platform.python_version(),
+                  'machine': platform.node(),
+                  'ijson': getattr(ijson, '__version__', None),
+                  'file_name': args.file_name,
+                  'dump_parameters': parameters,
+                  'dump_blake2b': file_digest(args.file_name),
+                  'megabytes': megabytes, 'rows': rows,
+                  'distinct_hashtags': len(hashtag_dict),
+                  'arguments': vars(args),
+                  'stages': results}
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent = 2)
+        print('Results saved to {0}.'.format(args.output))
+
+# -----------------------------------------------------------------------------